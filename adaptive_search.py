@@ -0,0 +1,211 @@
+#!/opt/python/bin/python2.7
+# Searches a sweep of STICA settings by successive halving: many combinations
+# are tried on a few recordings, and only the best ones on more recordings.
+# The combinations are sampled once, up front; later rounds only prune that
+# set, and never sample new combinations from the ranges that remain
+import argparse
+import csv
+import sys
+from math import ceil
+from multiprocessing import Pool
+from os import makedirs
+from os.path import basename, isdir, isfile, join
+from traceback import format_exc
+from numpy import array, median
+from numpy.random import RandomState
+from pandas import Series
+from image_index import load_index
+from sara import SaraUI
+from settings_space import SettingsSpace
+
+# Columns of the scores file
+SCORE_FIELDS = ['settings', 'recording', 'rois', 'snr']
+
+def makedir(d):
+  if not isdir(d):
+    makedirs(d)
+
+def combined_score(rows):
+  """Scores one combination of settings from its results on several recordings
+
+  The score is the median of the recordings' median trace SNR (see
+  :meth:`sara.SaraUI.score`), discounted by how much the number of
+  ROIs varies between recordings (divided by one plus the coefficient of
+  variation). Combinations that find no ROIs score 0.
+
+  """
+  rois = array([row['rois'] for row in rows], dtype=float)
+  if not rois.sum():
+    return 0.
+  stability = 1. / (1. + rois.std() / rois.mean())
+  return float(median([row['snr'] for row in rows])) * stability
+
+def evaluate(job):
+  """Segments one recording with several combinations and scores each one
+
+  Meant to be run in a worker process; output is logged to its own file.
+  The recording is motion-corrected once, and segmented with every
+  combination by :meth:`sara.SaraUI.segmentSweep`. Signals are exported to
+  ``out_dir/<settings name>/signals/``, as by ``sweep_single.py``, and
+  scored by :meth:`sara.SaraUI.score`.
+
+  Returns:
+    tuple: The recording, a list of score rows, and whether it succeeded.
+
+  """
+  path, sweep_file, candidates, out_dir, log_file = job
+  recording = basename(path)
+  no_ex = recording[:recording.find('.tif')]
+  for d in ['corrected', 'analysis']:
+    makedir(join(out_dir, d))
+  log = open(log_file, 'a')
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout = sys.stderr = log
+  rows = []
+  try:
+    ui = SaraUI(join(out_dir, 'analysis', no_ex + '.sima'), sweep_file,
+                candidates[0])
+    ui.motionCorrect(path, join(out_dir, 'corrected', recording),
+                     use_settings=True)
+    labels = ui.segmentSweep(candidates)
+    export_format = str(candidates[0].get('signals_export_format', 'csv'))
+    for settings in candidates:
+      name = settings['settings_name']
+      signals_dir = join(out_dir, name, 'signals')
+      makedir(signals_dir)
+      outfile = join(signals_dir, no_ex + '.' + export_format)
+      ui.rois = ui.dataset.ROIs[labels[name]]
+      ui.rois_label = labels[name]
+      ui.exportSignal(outfile, use_settings=True)
+      summary = ui.score()
+      rows.append({
+        'settings'  : name,
+        'recording' : no_ex,
+        'rois'      : summary['rois'],
+        'snr'       : summary.get('snr_median', 0.),
+      })
+    succeeded = True
+  except Exception:
+    print format_exc()
+    succeeded = False
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+    log.close()
+  return recording, rows, succeeded
+
+parser = argparse.ArgumentParser(
+  description="Search a sweep of settings by successive halving. Each round "
+              "evaluates the remaining combinations on more recordings, "
+              "and keeps the best 1/eta of them. Combinations are only "
+              "sampled at the start; rounds prune them, and never "
+              "resample.")
+parser.add_argument('sweep_file',
+                    help="sweep definition (see settings_space.py)")
+parser.add_argument('out_dir', help="where output will go")
+parser.add_argument('--settings', default='settings.csv',
+                    help="settings shared by every combination "
+                         "(default: settings.csv)")
+parser.add_argument('--candidates', type=int, default=27,
+                    help="combinations to start with, chosen at random if "
+                         "the sweep is larger (default: 27)")
+parser.add_argument('--eta', type=int, default=3,
+                    help="factor by which each round cuts the number of "
+                         "combinations and grows the number of recordings "
+                         "(default: 3)")
+parser.add_argument('--min-recordings', type=int, default=1,
+                    help="recordings used in the first round (default: 1)")
+parser.add_argument('--processes', type=int, default=1,
+                    help="recordings to analyze at once (default: 1)")
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+space = SettingsSpace(args.sweep_file)
+base = Series.from_csv(args.settings)
+rs = RandomState(args.seed)
+if len(space) <= args.candidates:
+  indices = range(len(space))
+else:
+  indices = set()
+  while len(indices) < args.candidates:
+    indices.add(rs.randint(len(space)))
+candidates = {}
+for index in sorted(indices):
+  candidates[space.name(index)] = space.settings(index, base)
+recordings = [entry['path'] for entry in load_index()]
+rs.shuffle(recordings)
+
+# Scores are kept on disk, so an interrupted search picks up where it stopped
+makedir(join(args.out_dir, 'logs'))
+scores_file = join(args.out_dir, 'search_scores.csv')
+scores = {}
+if isfile(scores_file):
+  with open(scores_file) as fh:
+    for row in csv.DictReader(fh):
+      row['rois'], row['snr'] = int(row['rois']), float(row['snr'])
+      scores[row['settings'], row['recording']] = row
+
+budget = min(args.min_recordings, len(recordings))
+round_number = 1
+while True:
+  used = recordings[:budget]
+  print "Round %d: %d combinations on %d recordings" % (
+          round_number, len(candidates), len(used))
+  sys.stdout.flush()
+
+  # only evaluate combinations that haven't been scored on a recording yet
+  jobs = []
+  for path in used:
+    no_ex = basename(path)[:basename(path).find('.tif')]
+    missing = [candidates[name] for name in sorted(candidates)
+               if (name, no_ex) not in scores]
+    if missing:
+      log_file = join(args.out_dir, 'logs', no_ex + '.log')
+      jobs.append((path, args.sweep_file, missing, args.out_dir, log_file))
+  if jobs:
+    if args.processes == 1:
+      results = map(evaluate, jobs)
+    else:
+      pool = Pool(min(args.processes, len(jobs)), maxtasksperchild=1)
+      results = pool.map(evaluate, jobs)
+      pool.close()
+      pool.join()
+    new_file = not isfile(scores_file)
+    with open(scores_file, 'ab') as fh:
+      writer = csv.DictWriter(fh, SCORE_FIELDS)
+      if new_file:
+        writer.writeheader()
+      for recording, rows, succeeded in results:
+        if not succeeded:
+          print "  %s FAILED (see %s)" % (recording,
+                                           join(args.out_dir, 'logs'))
+        for row in rows:
+          writer.writerow(row)
+          scores[row['settings'], row['recording']] = row
+
+  # rank combinations by their results on the recordings used so far
+  used_names = set(basename(p)[:basename(p).find('.tif')] for p in used)
+  ranking = []
+  for name in candidates:
+    rows = [row for (settings, recording), row in scores.iteritems()
+            if settings == name and recording in used_names]
+    ranking.append((combined_score(rows) if rows else 0., name))
+  ranking.sort(reverse=True)
+  for score, name in ranking:
+    print "  %-24s %8.3f" % (name, score)
+
+  if len(candidates) == 1 or budget == len(recordings):
+    break
+  keep = int(ceil(len(candidates) / float(args.eta)))
+  candidates = dict((name, candidates[name]) for _, name in ranking[:keep])
+  budget = min(budget * args.eta, len(recordings))
+  round_number += 1
+  # the range of values the remaining combinations span (informational
+  # only: no new combinations are sampled from it)
+  for param in space.names:
+    values = [settings[param] for settings in candidates.itervalues()]
+    print "  %s: %g to %g" % (param, min(values), max(values))
+
+best = ranking[0][1]
+best_file = join(args.out_dir, 'best_settings.csv')
+candidates[best].to_csv(best_file)
+print "Best settings:", best, "(saved to %s)" % best_file
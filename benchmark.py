@@ -0,0 +1,166 @@
+#!/opt/python/bin/python2.7
+# Benchmarks the SARA pipeline on synthetic recordings with known drift and
+# cells, reporting the throughput of each stage
+import argparse
+import csv
+from itertools import product
+from os import mkdir
+from os.path import isdir, isfile, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import matplotlib
+matplotlib.use('Agg') # headless; must happen before pyplot is imported
+from numpy import clip, exp, ogrid, uint16, zeros
+from numpy.random import RandomState
+from pandas import read_csv, Series
+from sima import ImagingDataset, Sequence
+from sara import SaraUI
+
+def synthetic_recording(path, frames, size, cells, drift, seed=0):
+  """Writes a synthetic single-channel TIFF stack to *path*
+
+  The recording is *size* x *size* pixels. Each of the *cells* fake cells
+  is a Gaussian blob whose brightness follows random calcium-like
+  transients, and the whole field of view drifts by a random walk of at
+  most *drift* pixels along each axis. Shot noise is added to every frame.
+
+  """
+  rs = RandomState(seed)
+  # cell footprints
+  y, x = ogrid[:size, :size]
+  centers = rs.uniform(size * 0.1, size * 0.9, (cells, 2))
+  radius = max(2., size / 40.)
+  footprints = [exp(-((y - cy)**2 + (x - cx)**2) / (2 * radius**2))
+                for cy, cx in centers]
+  # activity: random spikes with exponential decay
+  activity = zeros((cells, frames))
+  spikes = rs.rand(cells, frames) < 0.02
+  decay = exp(-1. / 10)
+  for t in xrange(frames):
+    previous = activity[:, t - 1] if t else 0
+    activity[:, t] = previous * decay + spikes[:, t]
+  # drift: a bounded random walk
+  shifts = clip(rs.randint(-1, 2, (frames, 2)).cumsum(axis=0), -drift, drift)
+
+  # pad by the drift so that shifted frames can be cropped back to size
+  pad = drift
+  data = zeros((frames, 1, size, size, 1), dtype=uint16)
+  padded = zeros((size + 2 * pad, size + 2 * pad))
+  for t in xrange(frames):
+    padded[:] = 500.
+    for footprint, level in zip(footprints, activity[:, t]):
+      padded[pad:pad + size, pad:pad + size] += 2000. * level * footprint
+    dy, dx = shifts[t]
+    frame = padded[pad + dy:pad + dy + size, pad + dx:pad + dx + size]
+    data[t, 0, :, :, 0] = clip(rs.poisson(frame), 0, 2**16 - 1)
+  dataset = ImagingDataset([Sequence.create('ndarray', data)], None)
+  dataset.export_frames([[[path]]], fmt='TIFF16')
+
+def benchmark_settings(path, components, drift, metrics_file):
+  """Writes a settings file for running the pipeline non-interactively"""
+  settings = Series({
+    'correction_strategy' : '2D Plane Correction',
+    'max_displacement_x'  : 2 * drift + 1,
+    'max_displacement_y'  : 2 * drift + 1,
+    'components'          : components,
+    'mu'                  : 0.5,
+    'overlap_per'         : 0.2,
+    'color_cycle'         : 'blue,red,magenta,brown,cyan,orange,yellow,green',
+    'linewidth'           : 2,
+    'rotation'            : 0,
+    'horizontal_flip'     : 0,
+    'vertical_flip'       : 0,
+    'signals_format'      : 'frame number',
+    'metrics_file'        : metrics_file,
+  })
+  settings.to_csv(path)
+
+def run_benchmark(workdir, frames, size, cells, drift, components):
+  """Runs the pipeline on one synthetic recording; returns its metrics"""
+  recording = join(workdir, 'synthetic.tif')
+  settings_file = join(workdir, 'settings.csv')
+  metrics_file = join(workdir, 'metrics.csv')
+  synthetic_recording(recording, frames, size, cells, drift)
+  benchmark_settings(settings_file, components, drift, metrics_file)
+
+  ui = SaraUI(join(workdir, 'synthetic.sima'), settings_file)
+  ui.motionCorrect(recording, join(workdir, 'corrected.tif'),
+                   use_settings=True)
+  ui.segment(use_settings=True)
+  ui.visualize(join(workdir, 'plot.png'), use_settings=True)
+  ui.exportSignal(join(workdir, 'signals.csv'), use_settings=True)
+  return read_csv(metrics_file)
+
+parser = argparse.ArgumentParser(
+  description="Benchmark SARA on synthetic recordings. Options that take "
+              "several values are benchmarked in every combination.")
+parser.add_argument('--frames', type=int, nargs='+', default=[500])
+parser.add_argument('--size', type=int, nargs='+', default=[128],
+                    help="width and height of each frame, in pixels")
+parser.add_argument('--cells', type=int, nargs='+', default=[20])
+parser.add_argument('--drift', type=int, default=5,
+                    help="maximum drift along each axis, in pixels")
+parser.add_argument('--components', type=int, nargs='+', default=[10])
+parser.add_argument('--repeats', type=int, default=1)
+parser.add_argument('--workdir', default=None,
+                    help="where to keep recordings and output (default: a "
+                         "temporary directory, deleted afterwards)")
+parser.add_argument('--output', default=None,
+                    help="CSV file to append per-stage results to")
+args = parser.parse_args()
+
+fields = ['frames', 'size', 'cells', 'components', 'repeat', 'stage',
+          'wall_time', 'cpu_time', 'peak_rss_mb', 'frames_per_second',
+          'megapixels_per_second']
+results = []
+for frames, size, cells, components in product(args.frames, args.size,
+                                               args.cells, args.components):
+  for repeat in xrange(args.repeats):
+    print "Benchmarking %d frames of %dx%d, %d cells, %d components" % (
+            frames, size, size, cells, components)
+    if args.workdir is None:
+      workdir = mkdtemp(prefix='sara_benchmark')
+    else:
+      workdir = join(args.workdir, 'f%d_s%d_c%d_pc%d_r%d' % (
+                       frames, size, cells, components, repeat))
+      if isdir(workdir):
+        rmtree(workdir)
+      mkdir(workdir)
+    metrics = run_benchmark(workdir, frames, size, cells, args.drift,
+                            components)
+    if args.workdir is None:
+      rmtree(workdir)
+    for _, row in metrics.iterrows():
+      results.append({
+        'frames'                : frames,
+        'size'                  : size,
+        'cells'                 : cells,
+        'components'            : components,
+        'repeat'                : repeat,
+        'stage'                 : row['stage'],
+        'wall_time'             : row['wall_time'],
+        'cpu_time'              : row['cpu_time'],
+        'peak_rss_mb'           : row['peak_rss_mb'],
+        'frames_per_second'     : frames / row['wall_time'],
+        'megapixels_per_second' : frames * size * size / 1e6 /
+                                    row['wall_time'],
+      })
+
+print ""
+print "%-14s %6s %5s %6s %10s %10s %12s" % (
+        'stage', 'frames', 'size', 'comps', 'wall (s)', 'frames/s', 'MP/s')
+for r in results:
+  print "%-14s %6d %5d %6d %10.2f %10.1f %12.2f" % (
+          r['stage'], r['frames'], r['size'], r['components'],
+          r['wall_time'], r['frames_per_second'],
+          r['megapixels_per_second'])
+
+if args.output is not None:
+  new_file = not isfile(args.output)
+  with open(args.output, 'ab') as fh:
+    writer = csv.DictWriter(fh, fields)
+    if new_file:
+      writer.writeheader()
+    writer.writerows(results)
+  print ""
+  print "Results appended to", args.output
@@ -0,0 +1,133 @@
+#!/opt/python/bin/python2.7
+# Builds and reads a persistent, ordered index of the recordings to analyze,
+# so that job scripts can find their recording without walking the data dir
+import csv
+from os import environ, fstat, rename, stat, walk
+from os.path import isfile, join
+from sys import argv
+
+# Where recordings are stored
+DATA_DIR = join(environ['HOME'], 'data')
+# Where the index is stored
+INDEX_FILE = 'image_index.csv'
+# Columns of the index file
+FIELDS = ['path', 'size', 'mtime', 'frames']
+# Extension of the file of byte offsets of each row of the index
+OFFSETS_EXTENSION = '.offsets'
+# Width of each entry in the offsets file, including the newline
+OFFSET_WIDTH = 16
+
+def count_frames(path):
+  """Returns the number of frames in a TIFF stack"""
+  # SIMA is only needed when (re)indexing, so don't import it for lookups
+  from sima import Sequence
+  return Sequence.create('TIFF', path).shape[0]
+
+def load_index(index_file=INDEX_FILE):
+  """Returns the index as a list of dicts, in job order"""
+  with open(index_file) as fh:
+    return list(csv.DictReader(fh))
+
+def update_index(data_dir=DATA_DIR, index_file=INDEX_FILE):
+  """Creates or refreshes the index of TIFF files in *data_dir*
+
+  The first time the index is built, recordings are sorted by path. On
+  later calls, the order of existing recordings is kept and new recordings
+  are appended (sorted by path), so job ids stay stable as data is added.
+  Frame counts are only re-read for new or modified files. Recordings that
+  no longer exist are dropped, which does shift later job ids.
+
+  Returns:
+    list: The updated index, as returned by :func:`load_index`.
+
+  """
+  old = []
+  if isfile(index_file):
+    old = load_index(index_file)
+  known = dict((entry['path'], entry) for entry in old)
+
+  found = []
+  for dirpath, dirnames, filenames in walk(data_dir):
+    for filename in filenames:
+      if filename.endswith('.tif'):
+        found.append(join(dirpath, filename))
+  found_set = set(found)
+
+  paths = [e['path'] for e in old if e['path'] in found_set]
+  paths += sorted(p for p in found if p not in known)
+  dropped = len(old) - len([e for e in old if e['path'] in found_set])
+  if dropped:
+    print "Warning: %d indexed recordings no longer exist" % dropped
+
+  index = []
+  for path in paths:
+    info = stat(path)
+    entry = known.get(path)
+    if entry is None or int(entry['size']) != info.st_size \
+    or float(entry['mtime']) != info.st_mtime:
+      entry = {
+        'path'   : path,
+        'size'   : info.st_size,
+        'mtime'  : repr(info.st_mtime),
+        'frames' : count_frames(path),
+      }
+    index.append(entry)
+
+  # write to a temporary file first so readers never see a partial index
+  tmp_file = index_file + '.tmp'
+  offsets = []
+  with open(tmp_file, 'w') as fh:
+    writer = csv.DictWriter(fh, FIELDS)
+    writer.writeheader()
+    for entry in index:
+      offsets.append(fh.tell())
+      writer.writerow(entry)
+    size = fh.tell()
+  # the offsets start with the size of the index they belong to, so that
+  # lookups can tell if they are out of date
+  tmp_offsets = index_file + OFFSETS_EXTENSION + '.tmp'
+  with open(tmp_offsets, 'w') as fh:
+    for offset in [size] + offsets:
+      fh.write('%0*d\n' % (OFFSET_WIDTH - 1, offset))
+  rename(tmp_offsets, index_file + OFFSETS_EXTENSION)
+  rename(tmp_file, index_file)
+  return index
+
+def image_path(job_id, index_file=INDEX_FILE):
+  """Returns the path of the *job_id*-th recording (counting from 1)
+
+  :func:`update_index` stores the byte offset of every row next to the
+  index, so the row is read directly instead of parsing the rows before it.
+  If the offsets are missing or belong to a different version of the index,
+  the index is scanned from the start.
+
+  """
+  if job_id < 1:
+    raise IndexError("Job %d is out of range of %s" % (job_id, index_file))
+  offsets_file = index_file + OFFSETS_EXTENSION
+  with open(index_file) as fh:
+    if isfile(offsets_file):
+      with open(offsets_file) as offsets:
+        size = offsets.read(OFFSET_WIDTH)
+        offsets.seek(job_id * OFFSET_WIDTH)
+        offset = offsets.read(OFFSET_WIDTH)
+      if size and int(size) == fstat(fh.fileno()).st_size:
+        if not offset:
+          raise IndexError("Job %d is out of range of %s" % (job_id,
+                                                             index_file))
+        fh.seek(int(offset))
+        return next(csv.reader(fh))[FIELDS.index('path')]
+    for n, entry in enumerate(csv.DictReader(fh), 1):
+      if n == job_id:
+        return entry['path']
+  raise IndexError("Job %d is out of range of %s" % (job_id, index_file))
+
+if __name__ == '__main__':
+  if len(argv) > 2:
+    print "Usage: %s [data_dir]" % argv[0]
+    print "  Creates or refreshes %s from the TIFF files in data_dir" \
+            % INDEX_FILE
+    print "  (default: %s)" % DATA_DIR
+    exit()
+  index = update_index(*argv[1:])
+  print len(index), "images indexed"
@@ -1,42 +1,82 @@
 #!/opt/python/bin/python2.7
 # Execute SARA analysis in series (as opposed to parallel) on one machine
-from os import environ, mkdir, walk
-from os.path import abspath, join, isdir
+from os import makedirs, mkdir
+from os.path import abspath, join, isdir, split
 from sys import argv
 from shutil import rmtree
-from sara import SaraUI
+from traceback import format_exc
+from image_index import image_path, load_index, update_index
 
-if len(argv) != 4:
+def usage():
+  program_name = argv[0]
+  print "Usage: %s job_id settings_file out_dir [setting_index]" \
+        % program_name
+  print "  'job_id' is the nth image file to analyze"
+  print "  'settings_file' is the settings file to use for analysis"
+  print "  'out_dir' is the directory where output will go"
+  print "  'setting_index' is the combination of a sweep to use; if given,"
+  print "  settings_file is a sweep definition (see settings_space.py),"
+  print "  and the combination is applied to the settings in settings.csv"
+  print ""
+  print "  If job_id is -1, then no SIMA analysis will be done; instead,"
+  print "  the image index is refreshed from the data dir and the number"
+  print "  of image files found will be output"
+  print ""
+  print "  If job_id is -2, then no SIMA analysis will be done; instead,"
+  print "  the name of the Nth image will be given. Use like:"
+  print "    %s -2 job_id" % program_name
+  print ""
+  print "  To run several tasks of a batch analysis in one process, use:"
+  print "    %s --pack first_task last_task out_dir" % program_name
+  print "  Tasks are numbered from 1 over every (image, setting) pair,"
+  print "  image by image, so that consecutive tasks share the image's"
+  print "  motion correction. Settings are chosen like sge_submit.sh"
+  print "  chooses them; out_dir is the top-level output directory"
+  exit()
+
+if not len(argv) in [4, 5]:
   if len(argv) == 2 and argv[1] == '-1':
     argv.append('')
     argv.append('')
   elif len(argv) == 3 and argv[1] == '-2':
     argv.append('')
   else:
-    program_name = argv[0]
-    print "Usage: %s job_id settings_file out_dir" % program_name
-    print "  'job_id' is the nth image file to analyze"
-    print "  'settings_file' is the settings file to use for analysis"
-    print "  'out_dir' is the directory where output will go"
-    print ""
-    print "  If job_id is -1, then no SIMA analysis will be done; instead,"
-    print "  the number of image files found in the data dir will be output"
-    print ""
-    print "  If job_id is -2, then no SIMA analysis will be done; instead,"
-    print "  the name of the Nth image will be given. Use like:"
-    print "    %s -2 job_id" % program_name
-    exit()
+    usage()
 
+# Run a range of tasks in this process
+packed = argv[1] == '--pack'
 # Nth image file to analyze
-job_id = int(argv[1])
+job_id = 0 if packed else int(argv[1])
 # File containing the settings we want use on all directories
 settings_file = argv[2]
 # Output directory
 outdir = argv[3]
+# Combination of a sweep to use, if settings_file defines a sweep
+setting_index = int(argv[4]) if len(argv) == 5 and not packed else None
+# images and tasks are numbered from 1
+if packed and (len(argv) != 5 or int(argv[2]) < 1) \
+or not packed and job_id not in [-1, -2] and job_id < 1:
+  usage()
+# Settings shared by every combination of a sweep
+SWEEP_BASE_SETTINGS = 'settings.csv'
 
 def run_sara(dirpath, recording, settings_file, analysis_dir, mc_dir,
-               plots_dir, signals_outdir):
-  """Use settings from previous run to analyze a new directory"""
+               plots_dir, signals_outdir, setting_index=None, previous=None):
+  """Use settings from previous run to analyze a new directory
+
+  If *previous* is the SaraUI that analyzed the same recording, its
+  motion correction is reused (see :meth:`sara.SaraUI.shareCorrection`).
+  Returns the SaraUI used for the analysis.
+
+  """
+  # importing SARA is slow, so only do it if there's analysis to run
+  from sara import SaraUI
+  settings = None
+  if setting_index != None:
+    from pandas import Series
+    from settings_space import SettingsSpace
+    settings = SettingsSpace(settings_file).settings(
+                 setting_index, Series.from_csv(SWEEP_BASE_SETTINGS))
   # remove .tif extension
   no_ex = recording[:recording.find('.tif')]
   # output locations
@@ -48,16 +88,74 @@ def run_sara(dirpath, recording, settings_file, analysis_dir, mc_dir,
   
   # run analysis
   print "Analyzing", recording
-  ui = SaraUI(sima_dir, settings_file)
+  ui = SaraUI(sima_dir, settings_file, settings)
+  if previous != None:
+    ui.shareCorrection(previous)
   ui.motionCorrect(mc_infile, mc_outfile, use_settings=True)
   ui.segment(use_settings=True)
   ui.visualize(plot_out, use_settings=True)
   ui.exportSignal(signal_out, use_settings=True)
+  ui.score()
+  return ui
+
+def output_dirs(outdir):
+  """Returns the job, corrected, plots, signals and analysis directories"""
+  return [outdir] + [join(outdir, d) for d in
+                     ['corrected', 'plots', 'signals', 'analysis']]
+
+def run_packed(first, last, out_root):
+  """Runs tasks *first* to *last* of a batch analysis in this process
+
+  Task *n* (counting from 1) analyzes image ``(n - 1) / S + 1`` with the
+  ``(n - 1) % S``-th of the *S* settings combinations (see
+  :func:`settings_space.batch_settings`), writing to the same directories
+  under *out_root* as ``sge_run.sh``. SARA is imported once, and
+  consecutive tasks on the same image reuse its loaded motion correction.
+  A failed task is reported and the remaining tasks still run.
+
+  Returns the number of tasks that failed.
+
+  """
+  from settings_space import batch_settings
+  combinations = batch_settings()
+  num_images = len(load_index())
+  last = min(last, num_images * len(combinations))
+  failures = 0
+  previous = None
+  for task in xrange(first, last + 1):
+    image_i = (task - 1) / len(combinations) + 1
+    name, settings_args = combinations[(task - 1) % len(combinations)]
+    dirpath, filename = split(image_path(image_i))
+    if name != None:
+      task_out = join(out_root, name)
+    elif num_images > 1:
+      task_out = join(out_root, filename.split('.')[0])
+    else:
+      task_out = out_root
+    task_settings = settings_args[0]
+    task_index = int(settings_args[1]) if len(settings_args) == 2 else None
+    dirs = output_dirs(task_out)
+    for d in dirs:
+      if not isdir(d):
+        makedirs(d)
+    print "(task %d of %d-%d)" % (task, first, last)
+    # only share correction between tasks on the same image
+    if previous != None and previous[0] != image_i:
+      previous = None
+    try:
+      ui = run_sara(dirpath, filename, task_settings, dirs[4], dirs[1],
+                    dirs[2], dirs[3], task_index,
+                    previous[1] if previous else None)
+      previous = (image_i, ui)
+    except Exception:
+      print format_exc()
+      failures += 1
+  return failures
 
 # Set up output directories for motion-corrected images, plots showing
 # segmentation results, and signals
 # MAKE SURE THESE NAMES ARE CORRECT OR ELSE ALL YOUR DATA WILL BE DELETED
-if job_id != -1:
+if job_id > 0:
   job_dir = "%s" % outdir
   mc_dir = "%s/corrected" % outdir
   plots_dir = "%s/plots" % outdir
@@ -69,37 +167,27 @@ if job_id != -1:
   #    rmtree(d)
   #  mkdir(d)
 
-# Find all of the image files
-home = environ['HOME']
-data_dir = join(home, 'data')
-nimages = 0
-images = []
-for dirpath, dirnames, filenames in walk(data_dir):
-  for filename in filenames:
-    # Run SARA, but only use original Control recordings
-    if filename.endswith('.tif'):
-      images.append(join(dirpath, filename))
-
-# Sort the images in alphabetical order
-images = sorted(images)
-
-for image in images:
-      nimages += 1
-      # run analysis on the nth image only
-      if job_id == nimages:
-        run_sara(dirpath, filename, settings_file, analysis_dir, mc_dir,
-                   plots_dir, signals_dir)
-
-if job_id == -1:
+if packed:
+  failures = run_packed(int(argv[2]), int(argv[3]), argv[4])
+  if failures:
+    exit("%d tasks failed" % failures)
+  print "Analysis done"
+elif job_id == -1:
+  # Build or refresh the index of image files
+  images = [entry['path'] for entry in update_index()]
   for image_name in images:
     print image_name
-  print nimages, "images found"
+  print len(images), "images found"
 elif job_id == -2:
   # Check the name of the Nth file
-  job_id = int(argv[2])
-  for n, image_name in enumerate(images, 1):
-    if n == job_id:
-      print image_name
+  print image_path(int(argv[2]))
 else:
+  # run analysis on the nth image only; output directories are made here
+  # when a scheduler (rather than sge_run.sh) starts the job
+  for d in [mc_dir, plots_dir, signals_dir, analysis_dir]:
+    if not isdir(d):
+      makedirs(d)
+  dirpath, filename = split(image_path(job_id))
+  run_sara(dirpath, filename, settings_file, analysis_dir, mc_dir,
+             plots_dir, signals_dir, setting_index)
   print "Analysis done"
-
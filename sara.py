@@ -1,19 +1,54 @@
-from os.path import abspath, isfile, isdir
+import csv
+from contextlib import contextmanager
+from hashlib import sha1
+from multiprocessing import current_process, Pool
+from json import dump, dumps, load, loads
+from os import getpid, link, makedirs, remove, rename, stat
+from os.path import abspath, basename, dirname, isfile, isdir, splitext
 from os.path import join as path_join
-from sys import exit, stdout
-from numpy import fliplr, flipud, less_equal, nonzero, rot90, sqrt
-from pandas import read_csv, Index, Series
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from shutil import copyfile, rmtree
+from sys import exit, platform, stdout
+from time import time
+from numpy import absolute, add, arange, around, array, asarray, clip, \
+                  column_stack, concatenate, conj, cumsum, diag, diff, \
+                  errstate, eye, fliplr, flipud, float32, full, hypot, \
+                  indices, isfinite, isnan, median, nanmax, nanmean, outer, \
+                  pi, percentile, repeat, roll, rot90, savetxt, savez, \
+                  savez_compressed, split, sqrt, stack, unravel_index, zeros
+from numpy import load as load_array
+from numpy.fft import fft2, fftshift, ifft2
+from numpy.lib.format import open_memmap
+from pandas import Index, Series
+from scipy.sparse import coo_matrix, diags
+from scipy.spatial import cKDTree
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 from matplotlib.widgets import Button
 from IPython.display import display
 from sima import Sequence, ImagingDataset
-from sima.motion import PlaneTranslation2D
+from sima.motion import MotionEstimationStrategy, PlaneTranslation2D
 from sima.ROI import ROI, ROIList
 from sima.segment import STICA
 from sima.segment.segment import PostProcessingStep
+from signal_store import directory_lock, SignalStore
 import ipywidgets as widgets
-import warnings
 import matplotlib.pyplot as plt
 
+# Name of the dataset holding frames in HDF5 files created by tiff_to_hdf5
+HDF5_KEY = 'imaging'
+
+# Columns of the segmentation scores file written by SaraUI.score
+SCORE_FIELDS = ['settings', 'recording', 'rois', 'frames', 'area_mean',
+                'area_median', 'compactness_median', 'looped_rois',
+                'snr_mean', 'snr_median', 'correlation_mean',
+                'correlation_max']
+# Columns of the per-run metrics file written by SaraUI
+METRICS_FIELDS = ['stage', 'rois_label', 'started', 'wall_time', 'cpu_time',
+                  'peak_rss_mb', 'frames', 'height', 'width', 'rois',
+                  'components']
+
 def ipython_loaded():
   """Returns ``True`` if ``__IPYTHON__`` is defined, ``False`` otherwise
      
@@ -28,33 +63,352 @@ def ipython_loaded():
   except NameError:
     return False
 
-def line_picker_generator(rid):
-  """Returns a function which returns the ID of a clicked ROI
+def file_digest(path, block_size=2**20):
+  """Returns the SHA-1 hex digest of a file's contents
+  
+  The file is read *block_size* bytes at a time, so large recordings are
+  hashed in constant memory.
   
   Args:
-    rid (int): ROI ID to bind *line_picker* function to
+    path (str): File to hash.
+    block_size (int, optional): Number of bytes to read at a time.
   Returns:
-    function: *line_picker* function. See `here <http://matplotlib.org/examples/event_handling/pick_event_demo.html>`_.
+    str: Hexadecimal digest of the file's contents.
   
   """
+  digest = sha1()
+  with open(path, 'rb') as fh:
+    block = fh.read(block_size)
+    while block:
+      digest.update(block)
+      block = fh.read(block_size)
+  return digest.hexdigest()
+
+def tiff_frames(path):
+  """Yields the frames of a TIFF stack one at a time
   
-  def line_picker(line, mouseevent):
-    if mouseevent.xdata is None: return False, dict()
-    xdata = line.get_xdata()
-    ydata = line.get_ydata()
-    maxd = 5
-    d = sqrt((xdata-mouseevent.xdata)**2. + (ydata-mouseevent.ydata)**2.)
-    
-    ind = nonzero(less_equal(d, maxd))
-    if len(ind[0]):
-      return True, {'rid': rid}
-    else:
-      return False, dict()
-  return line_picker
+  Uses `tifffile`_ if it is installed, and `libtiff`_ otherwise. Only one
+  frame is held in memory at a time.
+  
+  Args:
+    path (str): TIFF file to read.
+  
+  .. _tifffile:
+    https://pypi.python.org/pypi/tifffile
+  .. _libtiff:
+    https://pypi.python.org/pypi/libtiff
+  
+  """
+  try:
+    from tifffile import TiffFile
+  except ImportError:
+    from libtiff import TIFF
+    tiff = TIFF.open(path, 'r')
+    for frame in tiff.iter_images():
+      yield frame
+    tiff.close()
+    return
+  with TiffFile(path) as tif:
+    for page in tif.pages:
+      yield page.asarray()
+
+def tiff_to_hdf5(tiff_path, h5_path):
+  """Converts a single-channel TIFF stack to HDF5 in bounded memory
+  
+  Frames are copied one at a time into a dataset named ``HDF5_KEY`` with
+  dimensions ``tyx``, chunked by frame. The file is written under a
+  temporary name and renamed when complete, so concurrent jobs never read
+  a partial file.
+  
+  Args:
+    tiff_path (str): TIFF stack to convert.
+    h5_path (str): HDF5 file to create.
+  
+  """
+  import h5py
+  h5_dir = dirname(abspath(h5_path))
+  if not isdir(h5_dir):
+    try:
+      makedirs(h5_dir)
+    except OSError:
+      pass # created by a concurrent job
+  tmp_path = "%s.%d.tmp" % (h5_path, getpid())
+  with h5py.File(tmp_path, 'w') as h5:
+    frames = None
+    for t, frame in enumerate(tiff_frames(tiff_path)):
+      if frames is None:
+        frames = h5.create_dataset(
+                   HDF5_KEY, shape=(0,) + frame.shape, dtype=frame.dtype,
+                   maxshape=(None,) + frame.shape,
+                   chunks=(1,) + frame.shape)
+      frames.resize(t + 1, axis=0)
+      frames[t] = frame
+  rename(tmp_path, h5_path)
+
+def roi_mask_matrix(rois, volume_shape):
+  """Returns a sparse matrix that averages pixels within each ROI
+  
+  Row *i* of the matrix holds the mask of ``rois[i]``, flattened over
+  *volume_shape* and normalized to sum to one, so multiplying the matrix
+  by a column of flattened frames gives each ROI's mean intensity.
+  
+  Args:
+    rois (sima.ROI.ROIList): ROIs to build masks for.
+    volume_shape (tuple): ``(planes, rows, columns)`` of each frame.
+  Returns:
+    scipy.sparse.csr_matrix: Matrix of shape
+    ``(len(rois), planes * rows * columns)``.
+  
+  """
+  planes, height, width = volume_shape
+  roi_idx, pixel_idx, weights = [], [], []
+  for i, roi in enumerate(rois):
+    for plane, mask in enumerate(roi.mask):
+      mask = coo_matrix(mask)
+      roi_idx.append(full(mask.nnz, i, dtype=int))
+      pixel_idx.append((plane * height + mask.row) * width + mask.col)
+      weights.append(mask.data.astype(float32))
+  matrix = coo_matrix((concatenate(weights), (concatenate(roi_idx),
+                                              concatenate(pixel_idx))),
+                      shape=(len(rois), planes * height * width)).tocsr()
+  totals = asarray(matrix.sum(axis=1)).ravel()
+  totals[totals == 0] = 1
+  return diags(1. / totals, 0).dot(matrix).tocsr()
+
+def bin_frame(frame, spatial_bin):
+  """Averages *spatial_bin* x *spatial_bin* blocks of pixels in a 2D frame
+  
+  Rows and columns that don't fill a whole block are dropped.
+  
+  Args:
+    frame (numpy.ndarray): Frame of shape ``(rows, columns)``.
+    spatial_bin (int): Width and height of each block.
+  Returns:
+    numpy.ndarray: Frame of shape
+    ``(rows // spatial_bin, columns // spatial_bin)``.
+  
+  """
+  if spatial_bin == 1:
+    return frame
+  rows = frame.shape[0] // spatial_bin
+  cols = frame.shape[1] // spatial_bin
+  frame = frame[:rows * spatial_bin, :cols * spatial_bin]
+  return frame.reshape(rows, spatial_bin, cols, spatial_bin).mean(axis=(1, 3))
+
+def roi_shapes(rois):
+  """Returns the outline area, perimeter and number of loops of each ROI
+  
+  The outlines of all ROIs are packed into one array and measured at once.
+  Only the first loop of each ROI (the one :meth:`SaraUI.visualize`
+  draws) is measured.
+  
+  Args:
+    rois (sima.ROI.ROIList): ROIs to measure; must not be empty.
+  Returns:
+    tuple: Arrays of each ROI's polygon area and perimeter (in pixels), and
+    its number of coordinate sets (more than one means internal loops).
+  
+  """
+  loops = array([len(roi.coords) for roi in rois])
+  outlines = [roi.coords[0][:, :2] for roi in rois]
+  lengths = array([len(outline) for outline in outlines])
+  starts = concatenate([[0], cumsum(lengths)[:-1]])
+  xy = concatenate(outlines)
+  x, y = xy[:, 0], xy[:, 1]
+  # the vertex after each vertex, wrapping around within each outline
+  following = arange(len(xy)) + 1
+  following[starts + lengths - 1] = starts
+  cross = x * y[following] - x[following] * y
+  area = absolute(add.reduceat(cross, starts)) / 2
+  perimeter = add.reduceat(hypot(x[following] - x, y[following] - y), starts)
+  return area, perimeter, loops
+
+def trace_snr(signals):
+  """Returns the signal-to-noise ratio of each ROI trace
+  
+  A trace's signal is its 95th percentile above its median. Its noise is
+  estimated from the median absolute difference between consecutive frames,
+  which slow calcium transients barely affect. Traces without a finite
+  ratio (e.g. constant ones) are dropped.
+  
+  Args:
+    signals (numpy.ndarray): Array of shape ``(num_rois, num_frames)``.
+  Returns:
+    numpy.ndarray: The signal-to-noise ratio of each trace.
+  
+  """
+  signals = array(signals, dtype=float)
+  if not len(signals) or signals.shape[1] < 2:
+    return array([])
+  peak = percentile(signals, 95, axis=1) - median(signals, axis=1)
+  # for Gaussian noise, MAD * 1.4826 estimates the standard deviation, and
+  # differences of two frames have sqrt(2) times the noise of one
+  noise = median(absolute(diff(signals, axis=1)), axis=1) * 1.4826 / sqrt(2)
+  with errstate(invalid='ignore', divide='ignore'):
+    snr = peak / noise
+  return snr[isfinite(snr)]
+
+def trace_statistics(raw, block_frames=4096, block_rois=256):
+  """Returns the SNR and pairwise correlations of ROI traces
+  
+  Frames where any trace is missing are left out. Correlations are built
+  from the traces' sums and their matrix of products, read *block_frames*
+  frames at a time; :func:`trace_snr` is computed *block_rois* traces at a
+  time. Memory-mapped signals (see :meth:`SaraUI._extractBlocks`) are
+  therefore never loaded whole.
+  
+  Args:
+    raw (list): Arrays of shape ``(num_rois, num_frames)``, one per
+      sequence, as in :data:`SaraUI.signal`\ ``['raw']``.
+    block_frames (int, optional): Number of frames to read at a time.
+    block_rois (int, optional): Number of traces to read at a time.
+  Returns:
+    tuple: The signal-to-noise ratio of each trace (see :func:`trace_snr`),
+    and the ``(num_rois, num_rois)`` correlation matrix, or ``None`` if
+    there are fewer than two traces or usable frames.
+  
+  """
+  raw = list(raw)
+  num_rois = raw[0].shape[0] if raw else 0
+  blocks = [(r, start, min(start + block_frames, r.shape[1]))
+            for r in raw for start in xrange(0, r.shape[1], block_frames)]
+  # first pass: usable frames and the mean of each trace over them
+  valid = []
+  total = zeros(num_rois)
+  for r, start, stop in blocks:
+    block = asarray(r[:, start:stop], dtype=float)
+    keep = isfinite(block).all(axis=0)
+    total += block[:, keep].sum(axis=1)
+    valid.append(keep)
+  count = sum(keep.sum() for keep in valid)
+  
+  snr = [trace_snr(concatenate([asarray(r[start:start + block_rois],
+                                        dtype=float) for r in raw],
+                               axis=1)[:, concatenate(valid)])
+         for start in xrange(0, num_rois, block_rois)]
+  snr = concatenate(snr) if snr else array([])
+  if num_rois < 2 or count < 2:
+    return snr, None
+  
+  # second pass: products of the centered traces
+  mean = total / count
+  products = zeros((num_rois, num_rois))
+  for (r, start, stop), keep in zip(blocks, valid):
+    block = asarray(r[:, start:stop], dtype=float)[:, keep] - mean[:, None]
+    products += block.dot(block.T)
+  scale = sqrt(diag(products))
+  with errstate(invalid='ignore', divide='ignore'):
+    correlation = products / outer(scale, scale)
+  return snr, correlation
 
-def onpick(event):
-  print "Roi selected = ", event.rid
-  stdout.flush()
+def link_or_copy(src, dst):
+  """Hard-links *src* to *dst*, falling back to a copy across filesystems"""
+  if isfile(dst):
+    remove(dst)
+  try:
+    link(src, dst)
+  except OSError:
+    copyfile(src, dst)
+
+def cpu_time():
+  """Returns the CPU time used by this process and its finished children"""
+  total = 0.
+  for who in [RUSAGE_SELF, RUSAGE_CHILDREN]:
+    usage = getrusage(who)
+    total += usage.ru_utime + usage.ru_stime
+  return total
+
+def peak_rss_mb():
+  """Returns the peak resident memory of this process or its children, in MB
+  
+  This is the peak since the process started, not since the last call.
+  
+  """
+  peak = max(getrusage(who).ru_maxrss for who in [RUSAGE_SELF,
+                                                  RUSAGE_CHILDREN])
+  # Linux reports kilobytes; OS X reports bytes
+  if platform == 'darwin':
+    peak /= 1024.
+  return peak / 1024.
+
+def sweep_label(settings_name):
+  """Returns the ROI label used for a settings file in a segmentation sweep
+  
+  Args:
+    settings_name (str): Base name of the settings file.
+  Returns:
+    str: Label to store the settings file's ROIs under.
+  
+  """
+  return 'stICA ROIs ' + settings_name
+
+def render_plot(job):
+  """Saves one ROI plot with :meth:`SaraUI.visualize`
+  
+  Meant to be run in a worker process by :func:`render_plots`.
+  
+  Args:
+    job (tuple): The analysis directory, settings file, ROI label, and
+      where to save the plot.
+  Returns:
+    str: Where the plot was saved.
+  
+  """
+  sima_dir, settings_file, rois_label, save_to = job
+  ui = SaraUI(sima_dir, settings_file)
+  ui.rois_label = rois_label
+  ui.visualize(save_to, use_settings=True)
+  return save_to
+
+def render_plots(jobs, processes=1, ui=None):
+  """Saves many ROI plots, in a pool of worker processes
+  
+  Plots are rendered headlessly (see :meth:`SaraUI._renderROIs`), so this
+  works on cluster nodes without a display.
+  
+  Args:
+    jobs (list): Arguments for :func:`render_plot`, one tuple per plot.
+    processes (int, optional): Number of worker processes. If 1, plots are
+      rendered in this process.
+    ui (SaraUI, optional): A SaraUI that has loaded the jobs' analysis
+      directory, with the jobs' settings. If given and *processes* is 1,
+      it draws every plot, so the dataset isn't loaded again for each one.
+  Returns:
+    list: Where each plot was saved.
+  
+  """
+  if processes == 1 and ui != None:
+    for sima_dir, settings_file, rois_label, save_to in jobs:
+      ui.load()
+      ui.rois_label = rois_label
+      ui.rois = ui.dataset.ROIs[rois_label]
+      ui.visualize(save_to, use_settings=True)
+    return [job[-1] for job in jobs]
+  if processes == 1:
+    return map(render_plot, jobs)
+  pool = Pool(processes)
+  try:
+    return pool.map(render_plot, jobs)
+  finally:
+    pool.close()
+    pool.join()
+
+def onpick_generator(rids):
+  """Returns a pick event handler which prints the ID of clicked ROIs
+  
+  Args:
+    rids (list): ROI ID of each outline in the picked
+      :class:`matplotlib.collections.LineCollection`
+  Returns:
+    function: *onpick* function. See `here <http://matplotlib.org/examples/event_handling/pick_event_demo.html>`_.
+  
+  """
+  
+  def onpick(event):
+    for i in event.ind:
+      print "Roi selected = ", rids[i]
+    stdout.flush()
+  return onpick
 
 class CommandLineInterface(object):
   """A command-line based UI for grabbing user input.
@@ -401,6 +755,248 @@ class CommandLineInterface(object):
         return self.reserveDirectory(None, extension)
     return path
   
+# (strategy, sequence, reference) being estimated by BlockParallelStrategy;
+# inherited by the worker processes when they are forked
+_block_source = None
+
+def _estimate_block(bounds):
+  """Estimates displacements of frames ``bounds[0]:bounds[1]`` in a worker
+  
+  The block is estimated together with the shared reference frame, and
+  returned relative to the reference's displacement.
+  
+  """
+  strategy, sequence, reference = _block_source
+  start, stop = bounds
+  block = ImagingDataset([reference, sequence[start:stop]], None)
+  reference_displacement, displacements = strategy.estimate(block)
+  return displacements - reference_displacement[0]
+
+class BlockParallelStrategy(MotionEstimationStrategy):
+  """Runs a SIMA motion estimation strategy on blocks of frames in parallel.
+  
+  Each sequence is split into blocks of *block_frames* frames, and each
+  block is extended by *overlap* frames into the next. Blocks are
+  estimated by *strategy* in a pool of *processes* worker processes.
+  
+  So that every block ends up in the same frame of reference, a reference
+  frame is made first: the mean of *reference_frames* frames sampled evenly
+  across the whole sequence. Each block is estimated along with the
+  reference (as a sequence of its own), and its displacements are taken
+  relative to the reference's. Blocks are therefore never stitched to each
+  other, and errors don't build up along long recordings. The frames that
+  adjacent blocks share are only used to check that they agree; a warning
+  is printed if they differ by more than a pixel.
+  
+  Worker processes can't be started from a daemonic process (such as a
+  :class:`multiprocessing.Pool` worker); blocks are then estimated one
+  after another, with a warning.
+  
+  Example:
+    Correcting a sequence with 8 processes::
+    
+      strategy = BlockParallelStrategy(
+                   PlaneTranslation2D(max_displacement=[20, 20]), 8)
+      dataset = strategy.correct([sequence], 'corrected.sima')
+  
+  Args:
+    strategy (sima.motion.MotionEstimationStrategy): Strategy to run on
+      each block.
+    processes (int): Number of worker processes.
+    block_frames (int, optional): Number of frames per block.
+    overlap (int, optional): Number of frames shared by adjacent blocks.
+    reference_frames (int, optional): Number of frames averaged into the
+      shared reference.
+  
+  """
+  
+  def __init__(self, strategy, processes, block_frames=1000, overlap=50,
+               reference_frames=100):
+    self.strategy = strategy
+    self.processes = processes
+    self.block_frames = block_frames
+    self.overlap = overlap
+    self.reference_frames = reference_frames
+  
+  def _estimate(self, dataset):
+    displacements = [self._estimateSequence(sequence)
+                     for sequence in dataset.sequences]
+    # SIMA expects the smallest displacement along each axis to be zero
+    lowest = concatenate([d.reshape(-1, d.shape[-1]) for d in displacements])
+    lowest = lowest.min(axis=0)
+    return [d - lowest for d in displacements]
+  
+  def _estimateSequence(self, sequence):
+    """Estimates the displacements of one sequence, block by block"""
+    global _block_source
+    length = sequence.shape[0]
+    bounds = [(start, min(start + self.block_frames + self.overlap, length))
+              for start in xrange(0, length, self.block_frames)]
+    _block_source = (self.strategy, sequence, self._reference(sequence))
+    try:
+      if current_process().daemon:
+        print "Warning: can't start worker processes from a daemonic" \
+              " process; estimating motion one block at a time"
+        stdout.flush()
+        blocks = map(_estimate_block, bounds)
+      else:
+        pool = Pool(min(self.processes, len(bounds)))
+        try:
+          blocks = pool.map(_estimate_block, bounds)
+        finally:
+          pool.close()
+          pool.join()
+    finally:
+      _block_source = None
+    
+    displacements = blocks[0]
+    for (start, stop), block in zip(bounds[1:], blocks[1:]):
+      shared = min(len(displacements) - start, len(block))
+      mismatch = median(absolute(displacements[start:start + shared] -
+                                 block[:shared]))
+      if mismatch > 1:
+        print "Warning: blocks disagree by %g pixels around frame %d" % (
+                mismatch, start)
+      displacements = concatenate([displacements, block[shared:]])
+    return displacements
+  
+  def _reference(self, sequence):
+    """Returns the mean of frames sampled evenly across *sequence*
+    
+    The mean is returned as a one-frame :class:`sima.Sequence`. Pixels
+    without data in any sampled frame are set to zero.
+    
+    """
+    length = sequence.shape[0]
+    step = max(1, length // self.reference_frames)
+    frames = [next(iter(sequence[t:t + 1]))
+              for t in range(0, length, step)[:self.reference_frames]]
+    with errstate(invalid='ignore'):
+      reference = nanmean(array(frames, dtype=float32), axis=0)
+    reference[isnan(reference)] = 0
+    return Sequence.create('ndarray', reference[None])
+
+class PhaseCorrelation2D(MotionEstimationStrategy):
+  """Estimates rigid plane translations by FFT phase correlation.
+  
+  A much faster alternative to :class:`sima.motion.PlaneTranslation2D`
+  for recordings whose motion is a rigid drift of the whole field of view.
+  Frames are read in batches of *batch_frames*, and each batch is
+  registered against a reference image with one stack of FFTs. The peak of
+  each frame's phase correlation is only searched within
+  *max_displacement* of zero, and refined to subpixel precision with a
+  parabolic fit (SIMA applies displacements in whole pixels, so they are
+  rounded when returned). The reference starts as the mean frame, and is
+  replaced by the mean of the aligned frames on each further iteration.
+  
+  Only the first channel is used for estimation.
+  
+  Args:
+    max_displacement (list, optional): Maximum displacement along each
+      axis, in the same order as for
+      :class:`sima.motion.PlaneTranslation2D`. If None, any displacement
+      is allowed.
+    batch_frames (int, optional): Number of frames to transform at a time.
+    iterations (int, optional): Number of registration passes.
+  
+  """
+  
+  def __init__(self, max_displacement=None, batch_frames=64, iterations=2):
+    self.max_displacement = max_displacement
+    self.batch_frames = batch_frames
+    self.iterations = iterations
+  
+  def _batches(self, sequence):
+    """Yields (start, frames) for batches of first-channel frames"""
+    length = sequence.shape[0]
+    for start in xrange(0, length, self.batch_frames):
+      stop = min(start + self.batch_frames, length)
+      frames = array(list(sequence[start:stop]), dtype=float32)[..., 0]
+      frames[isnan(frames)] = 0
+      yield start, frames
+  
+  def _estimate(self, dataset):
+    displacements = []
+    for sequence in dataset.sequences:
+      length = sequence.shape[0]
+      # initial reference: the mean frame
+      reference = 0
+      for start, frames in self._batches(sequence):
+        reference = reference + frames.sum(axis=0)
+      reference = reference / length
+      for iteration in xrange(self.iterations):
+        shifts = self._register(sequence, reference)
+        if iteration + 1 < self.iterations:
+          reference = self._alignedMean(sequence, shifts)
+      # frames moved by +shift; SIMA needs where to place them instead
+      d = -around(shifts).astype(int)
+      displacements.append(d - d.reshape(-1, 2).min(axis=0))
+    return displacements
+  
+  def _alignedMean(self, sequence, shifts):
+    """Returns the mean of the frames after undoing whole-pixel *shifts*"""
+    shifts = around(shifts).astype(int)
+    total = 0
+    for start, frames in self._batches(sequence):
+      for t, frame in enumerate(frames, start):
+        for plane in xrange(frame.shape[0]):
+          dy, dx = shifts[t, plane]
+          frame[plane] = roll(roll(frame[plane], -dy, 0), -dx, 1)
+      total = total + frames.sum(axis=0)
+    return total / sequence.shape[0]
+  
+  def _register(self, sequence, reference):
+    """Returns subpixel [y, x] shifts of every frame relative to *reference*
+    
+    The result has shape ``(num_frames, num_planes, 2)``.
+    
+    """
+    planes, height, width = reference.shape
+    if self.max_displacement is None:
+      max_y, max_x = height // 2, width // 2
+    else:
+      max_y = min(int(self.max_displacement[0]), height // 2 - 1)
+      max_x = min(int(self.max_displacement[1]), width // 2 - 1)
+    center_y, center_x = height // 2, width // 2
+    conj_ref = conj(fft2(reference))
+    
+    shifts = []
+    for start, frames in self._batches(sequence):
+      cross = fft2(frames) * conj_ref
+      cross /= abs(cross) + 1e-12
+      corr = fftshift(ifft2(cross).real, axes=(-2, -1))
+      # only search within the maximum displacement of zero shift
+      window = corr[..., center_y - max_y:center_y + max_y + 1,
+                    center_x - max_x:center_x + max_x + 1]
+      win_h, win_w = window.shape[-2:]
+      flat = window.reshape(window.shape[:2] + (-1,))
+      peak_y, peak_x = unravel_index(flat.argmax(axis=-1), (win_h, win_w))
+      # parabolic subpixel refinement along each axis, away from the edges
+      b, p = indices(peak_y.shape)
+      sub_y = self._parabola(window, b, p, peak_y, peak_x, win_h, axis=0)
+      sub_x = self._parabola(window, b, p, peak_y, peak_x, win_w, axis=1)
+      shifts.append(stack([peak_y + sub_y - max_y, peak_x + sub_x - max_x],
+                          axis=-1))
+    return concatenate(shifts)
+  
+  @staticmethod
+  def _parabola(window, b, p, peak_y, peak_x, size, axis):
+    """Returns the subpixel offset of each peak along *axis* (0 = y)"""
+    peak = peak_y if axis == 0 else peak_x
+    inside = (peak > 0) & (peak < size - 1)
+    before, after = clip(peak - 1, 0, size - 1), clip(peak + 1, 0, size - 1)
+    if axis == 0:
+      c0 = window[b, p, peak_y, peak_x]
+      cm, cp = window[b, p, before, peak_x], window[b, p, after, peak_x]
+    else:
+      c0 = window[b, p, peak_y, peak_x]
+      cm, cp = window[b, p, peak_y, before], window[b, p, peak_y, after]
+    denominator = cm - 2 * c0 + cp
+    with errstate(invalid='ignore', divide='ignore'):
+      offset = 0.5 * (cm - cp) / denominator
+    offset[~inside | (denominator == 0)] = 0
+    return clip(offset, -0.5, 0.5)
+
 class IdROIs(PostProcessingStep):
   """A SIMA segmentation post-processing step to give IDs to rois"""
   def apply(self, rois, dataset=None):
@@ -427,6 +1023,10 @@ class SaraUI(CommandLineInterface):
     
     ui = sara.SaraUI(sima_dir='mydir.sima', settings_file='settings.csv')
   
+  Settings that are already loaded (e.g. generated by a script) can be
+  passed as a :class:`pandas.Series` with *settings*; they are used instead
+  of reading *settings_file*, and no radio buttons are shown.
+  
   Note that choosing the former approach will cause ``".sima"`` to be
   appended to the end of the directory name you choose if it does not
   already end in ``".sima"``.
@@ -436,6 +1036,12 @@ class SaraUI(CommandLineInterface):
   for selecting signal output format and motion-correction strategy. These
   options will be read from *settings_file*.
   
+  When *use_settings* is True, each stage (:meth:`.motionCorrect`,
+  :meth:`.segment`, :meth:`.visualize` and :meth:`.exportSignal`) writes a
+  completion manifest to :data:`sima_dir`, and is skipped on later runs as
+  long as its inputs, settings and outputs are unchanged. Re-running a job
+  after it was interrupted only repeats the stages that did not finish.
+  
   It is recommended to use ``SARA.ipynb`` to test settings on a few
   recordings individually. This will cause a settings file to be generated,
   which can be edited manually and loaded outside of an IPython
@@ -447,6 +1053,9 @@ class SaraUI(CommandLineInterface):
     mc_radio (ipywidgets.RadioButtons):
       Radio Button widget for choosing motion-correction strategy.
     rois (sima.ROI.ROIList): ROIs that were found by :meth:`.segment`.
+    rois_label (str): Label of :data:`rois` in the dataset. Defaults to
+      ``"stICA ROIs"``; :meth:`.segmentSweep` stores one label per
+      parameter combination.
     sequence (sima.Sequence): Imaging sequence generated using
       :meth:`sima.Sequence.create` when :meth:`.motionCorrect` is called.
     settings_file (str): File to save settings used for analysis.
@@ -455,13 +1064,15 @@ class SaraUI(CommandLineInterface):
     signal_radio (ipywidgets.RadioButtons):
       Radio Button widget for whether to convert "frames" column of signal
       output to time format.
+    export_radio (ipywidgets.RadioButtons):
+      Radio Button widget for choosing the signal file format.
   
   .. _SIMA:
     http://www.losonczylab.org/sima/1.0/index.html
   
   """
   
-  def __init__(self, sima_dir=None, settings_file=None):
+  def __init__(self, sima_dir=None, settings_file=None, settings=None):
     # general parameters
     if sima_dir == None:
       prompt = "Name of SIMA analysis directory (ends with .sima): "
@@ -472,14 +1083,21 @@ class SaraUI(CommandLineInterface):
       prompt = "Path to save settings: "
       self.settings_file = self.reserveFilePath(prompt)
       self.settings = None
-    else:
+    elif settings is None:
       self.settings_file = settings_file
       self.settings = Series.from_csv(settings_file)
+    else:
+      self.settings_file = settings_file
+      self.settings = settings
     self.sequence = None
     self.dataset = None
     self.rois = None
+    self.rois_label = 'stICA ROIs'
     # signal extraction parameters
     self._signal_output = ['time', 'frame number']
+    self._signal_label = None
+    self._signal_inputs = None
+    self._signal_export_formats = ['csv', 'npy', 'npz']
     self.signal = None
     # motion correction parameters
     self.mc_radio = None
@@ -487,25 +1105,330 @@ class SaraUI(CommandLineInterface):
     self._rotation = 0
     self._hflip = False
     self._vflip = False
+    self._color_cycle = ['blue', 'red', 'magenta', 'brown', 'cyan',
+                         'orange', 'yellow', 'green']
+    self._linewidth = 2
+    self._backgrounds = {}
+    self._backgrounds_source = None
+    self._roi_coords = {}
+    self._roi_coords_source = None
+    self._roi_indexes = {}
+    # correction of the recording, possibly shared with another SaraUI
+    self._correction = None
+    self._correction_source = None
+    self._correction_reused = False
     # maps radio options to function calls, shown in alphabetical order
     self._motion_correction_map = {
       "2D Plane Correction" : self._planeTranslation2D,
+      "Phase Correlation"   : self._phaseCorrelation2D,
     }
     # If SaraUI is initialized outside of IPython,
     # a settings file MUST BE USED
-    if ipython_loaded():
+    if ipython_loaded() and settings is None:
       options = self._motion_correction_map.keys()
       options.sort() # force alphabetical order
       label = "Motion correction strategy:"
       self.strategy_radio = self._showRadio(label, options)
       label = "Label signal output by time or by frame number?"
       self.signal_radio = self._showRadio(label, self._signal_output)
+      label = "Signal file format:"
+      self.export_radio = self._showRadio(label,
+                                          self._signal_export_formats)
 
+  def _background(self):
+    """Returns the background image for :meth:`._plotROIs`.
+    
+    The image is the thumbnail from :meth:`._thumbnail`, flipped and
+    rotated to the current orientation. Each orientation is only computed
+    once per dataset, so rotating and flipping in the viewer doesn't touch
+    the time averages.
+    
+    Returns:
+      tuple: The image and the ``(rows, columns)`` shape of full-resolution
+      frames in the current orientation.
+    
+    """
+    if self._backgrounds_source is not self.dataset:
+      self._backgrounds = {None : self._thumbnail()}
+      self._backgrounds_source = self.dataset
+    key = (self._rotation, self._hflip, self._vflip)
+    if key not in self._backgrounds:
+      imdata, shape = self._backgrounds[None]
+      # Perform flips
+      if self._hflip:
+        imdata = fliplr(imdata)
+      if self._vflip:
+        imdata = flipud(imdata)
+      # Perform rotation
+      if self._rotation:
+        imdata = rot90(imdata, self._rotation / 90)
+        if self._rotation % 180:
+          shape = shape[::-1]
+      self._backgrounds[key] = (imdata, shape)
+    return self._backgrounds[key]
+  
+  def _correct(self, strategy):
+    """Corrects :data:`sequence` with *strategy* and exports the frames.
+    
+    If the ``mc_processes`` setting is greater than one, motion is
+    estimated in parallel over blocks of frames with
+    :class:`BlockParallelStrategy`; blocks are ``mc_block_frames`` long
+    (default 1000) and overlap by ``mc_block_overlap`` frames (default 50),
+    and are registered against the mean of ``mc_reference_frames`` frames
+    (default 100).
+    
+    Args:
+      strategy (sima.motion.MotionEstimationStrategy): Strategy used to
+        estimate displacements.
+    
+    """
+    processes = int(self._setting('mc_processes', 1))
+    if processes > 1:
+      strategy = BlockParallelStrategy(
+                   strategy, processes,
+                   int(self._setting('mc_block_frames', 1000)),
+                   int(self._setting('mc_block_overlap', 50)),
+                   int(self._setting('mc_reference_frames', 100)))
+    self.dataset = strategy.correct([self.sequence], self.sima_dir)
+    self.dataset.export_frames([[[self.corrected_frames]]])
+  
+  def _extract(self):
+    """Sets :data:`signal` to the signals of :data:`rois`.
+    
+    Signals are only extracted if :data:`signal` doesn't already hold them
+    and they aren't stored in the dataset, or if :data:`rois` changed since
+    they were extracted. Stored signals are checked against the segment
+    manifest with an ``extract`` manifest, so a re-segmentation is noticed
+    even by a later run that resumes after it. If the settings file has an
+    ``extraction_block_frames`` entry greater than zero, signals are
+    extracted with :meth:`._extractBlocks` instead of
+    :meth:`sima.ImagingDataset.extract`, using blocks of that many frames.
+    
+    """
+    if self.rois == None:
+      self.load()
+      self.rois = self.dataset.ROIs[self.rois_label]
+    signal_label = self._signalLabel()
+    # signals are current if extracted from the latest segmentation; ROIs
+    # without a segment manifest weren't found by SARA, so never change
+    rois_inputs = self._stageInputs('segment')
+    if self.signal != None and self._signal_label == signal_label \
+    and self._signal_inputs == rois_inputs:
+      return
+    block_frames = int(self._setting('extraction_block_frames', 0))
+    if block_frames > 0:
+      print "Extracting signals from ROIs in blocks of", block_frames, \
+            "frames..."
+      stdout.flush()
+      with self._measure('extract'):
+        self.signal = self._extractBlocks(block_frames)
+      print "Signals extracted"
+    elif signal_label in self.dataset.signals() and (rois_inputs == None
+         or self._stageComplete('extract', rois_inputs, {})):
+      self.signal = self.dataset.signals()[signal_label]
+    else:
+      print "Extracting signals from ROIs..."
+      stdout.flush() # force print statement to output to IPython
+      with self._measure('extract'):
+        self.signal = self.dataset.extract(rois=self.rois,
+                                           label=signal_label)
+      self._recordStage('extract', rois_inputs, {})
+      print "Signals extracted"
+    self._signal_label = signal_label
+    self._signal_inputs = rois_inputs
+  
+  def _extractBlocks(self, block_frames):
+    """Extracts signals from :data:`rois` in bounded memory.
+    
+    Builds the sparse ROI mask matrix once (see :func:`roi_mask_matrix`),
+    then streams the dataset in blocks of *block_frames* frames, computing
+    the mean of every ROI in each frame with one sparse matrix product per
+    block. Pixels without data (e.g. NaNs at the edges of motion-corrected
+    frames) are excluded from the means. Signals are written as they are
+    computed to a float32 ``.npy`` file in :data:`sima_dir` named after
+    :meth:`._signalLabel`, so memory use depends on the block size rather
+    than the length of the recording.
+    
+    Args:
+      block_frames (int): Number of frames to read at a time.
+    Returns:
+      dict: Signals in the same format as
+      :meth:`sima.ImagingDataset.extract`, with ``'raw'`` signals
+      memory-mapped from the ``.npy`` file.
+    
+    """
+    masks = roi_mask_matrix(self.rois, self.dataset.frame_shape[:3])
+    num_frames = sum(seq.shape[0] for seq in self.dataset.sequences)
+    path = path_join(self.sima_dir,
+                     self._signalLabel().replace(' ', '_') + '.npy')
+    signals = open_memmap(path, mode='w+', dtype=float32,
+                          shape=(len(self.rois), num_frames))
+    raw = []
+    offset = 0
+    for sequence in self.dataset.sequences:
+      length = sequence.shape[0]
+      for start in xrange(0, length, block_frames):
+        stop = min(start + block_frames, length)
+        # first channel only; flatten each frame to a column
+        block = array(list(sequence[start:stop]), dtype=float32)[..., 0]
+        block = block.reshape(stop - start, -1).T
+        valid = ~isnan(block)
+        block[~valid] = 0
+        totals = masks.dot(block)
+        weights = masks.dot(valid.astype(float32))
+        with errstate(invalid='ignore', divide='ignore'):
+          signals[:, offset + start:offset + stop] = totals / weights
+      raw.append(signals[:, offset:offset + length])
+      offset += length
+    signals.flush()
+    rois = [{'id': roi.id, 'label': roi.label, 'tags': roi.tags}
+            for roi in self.rois]
+    return {'raw': raw, 'rois': rois}
+  
+  def _inputSequence(self, input_path, input_digest=None):
+    """Returns a :class:`sima.Sequence` for an uncorrected TIFF stack.
+    
+    SIMA may read a whole TIFF stack into memory, which is not possible for
+    recordings larger than RAM. If the ``input_cache_dir`` setting is
+    given, the TIFF is instead converted (once, in bounded memory; see
+    :func:`tiff_to_hdf5`) to an HDF5 file in that directory, named after
+    the TIFF's contents. SIMA reads HDF5 sequences lazily, so motion
+    correction, time averages and signal extraction then stream frames
+    from disk. The conversion isn't measured on its own, since
+    :data:`sima_dir` (where metrics go by default) may not exist yet; its
+    time is part of the stage that needed the sequence.
+    
+    Args:
+      input_path (str): File path to the TIFF stack.
+      input_digest (str, optional): :func:`file_digest` of *input_path*, if
+        already known.
+    
+    """
+    cache_dir = self._setting('input_cache_dir')
+    if cache_dir == None:
+      return Sequence.create('TIFF', input_path)
+    if input_digest == None:
+      input_digest = file_digest(input_path)
+    h5_path = path_join(cache_dir, input_digest + '.h5')
+    if not isfile(h5_path):
+      print "Converting", input_path, "to HDF5 . . ."
+      stdout.flush()
+      tiff_to_hdf5(input_path, h5_path)
+    return Sequence.create('HDF5', h5_path, 'tyx', key=HDF5_KEY)
+  
+  def _loadCachedCorrection(self, cache_dir, key):
+    """Reuses a motion-corrected dataset from the motion-correction cache.
+    
+    If *cache_dir* holds a dataset and exported frames for *key*, a new
+    dataset is created in :data:`sima_dir` from the cached (already
+    corrected) sequences, and the cached frames are linked to the corrected
+    frames path.
+    
+    Args:
+      cache_dir (str): Directory containing the motion-correction cache.
+      key (str): Cache key generated by :meth:`._mcCacheKey`.
+    Returns:
+      bool: ``True`` if the cache was used, ``False`` otherwise.
+    
+    """
+    cached_dir = path_join(cache_dir, key + '.sima')
+    cached_frames = path_join(cache_dir, key + '.tif')
+    if not (isdir(cached_dir) and isfile(cached_frames)):
+      return False
+    print "Using cached motion correction", key
+    stdout.flush()
+    cached = ImagingDataset.load(cached_dir)
+    self.dataset = ImagingDataset(cached.sequences, self.sima_dir)
+    link_or_copy(cached_frames, self.corrected_frames)
+    return True
+  
+  @contextmanager
+  def _measure(self, stage, components=None):
+    """Records the resources used by the code in a ``with`` block.
+    
+    Appends a row to the metrics file (``sara_metrics.csv`` in
+    :data:`sima_dir`, or the ``metrics_file`` setting) with the wall time,
+    CPU time (including finished child processes) and peak resident memory
+    of the block, along with the size of the data it worked on. Nothing is
+    recorded if the block raises an exception.
+    
+    Args:
+      stage (str): Name of the stage being measured.
+      components (int, optional): Number of PCA components, if relevant.
+    
+    """
+    start_wall = time()
+    start_cpu = cpu_time()
+    yield
+    row = {
+      'stage'       : stage,
+      'rois_label'  : self.rois_label,
+      'started'     : start_wall,
+      'wall_time'   : time() - start_wall,
+      'cpu_time'    : cpu_time() - start_cpu,
+      'peak_rss_mb' : peak_rss_mb(),
+      'components'  : components,
+    }
+    if self.dataset != None:
+      row['frames'] = self.dataset.num_frames
+      row['height'], row['width'] = self.dataset.frame_shape[1:3]
+    if self.rois != None:
+      row['rois'] = len(self.rois)
+    
+    metrics_file = self._setting('metrics_file',
+                                 path_join(self.sima_dir, 'sara_metrics.csv'))
+    new_file = not isfile(metrics_file)
+    with open(metrics_file, 'ab') as fh:
+      writer = csv.DictWriter(fh, METRICS_FIELDS)
+      if new_file:
+        writer.writeheader()
+      writer.writerow(row)
+  
+  def _mcCacheKey(self, input_digest, strategy, max_displacement):
+    """Returns the motion-correction cache key for a recording.
+    
+    The key is content-addressed: it depends on the contents of the input
+    TIFF, not its path, so the same recording is only corrected once no
+    matter how many settings files refer to it.
+    
+    Args:
+      input_digest (str): :func:`file_digest` of the uncorrected image.
+        Keys that are only compared in memory (see :meth:`.shareCorrection`)
+        may identify the image by path, size and modification time instead.
+      strategy (str): Name of the motion-correction strategy.
+      max_displacement (list): Maximum displacement as ``[x, y]``.
+    Returns:
+      str: Hexadecimal cache key.
+    
+    """
+    key = sha1()
+    key.update(input_digest)
+    key.update(strategy)
+    key.update(','.join(map(str, max_displacement)))
+    return key.hexdigest()
+  
+  def _phaseCorrelation2D(self, mc_settings):
+    """Performs rigid motion correction with FFT phase correlation.
+    
+    Uses :class:`PhaseCorrelation2D` with settings chosen in
+    :meth:`.motionCorrect`, in parallel if configured (see
+    :meth:`._correct`).
+    
+    Args:
+      mc_settings (dict) : The settings to use for motion correction.
+    
+    """
+    print "Performing motion correction with Phase Correlation . . ."
+    stdout.flush() # force print statement to output to IPython
+    self._correct(PhaseCorrelation2D(**mc_settings))
+    print "Motion correction complete"
+  
   def _planeTranslation2D(self, mc_settings):
     """Performs motion correction with 2D Plane Translation.
     
     Uses :meth:`sima.motion.PlaneTranslation2D` with settings chosen
-    in :meth:`.motionCorrect`.
+    in :meth:`.motionCorrect`, in parallel if configured (see
+    :meth:`._correct`).
     
     Args:
       mc_settings (dict) : The settings to use for motion correction.
@@ -514,47 +1437,47 @@ class SaraUI(CommandLineInterface):
     print "Performing motion correction with 2D Plane Correction " + \
           "(this could take a while) . . ."
     stdout.flush() # force print statement to output to IPython
-    self.dataset = PlaneTranslation2D(**mc_settings).correct(
-                     [self.sequence], self.sima_dir)
+    self._correct(PlaneTranslation2D(**mc_settings))
     print "Motion correction complete"
-    self.dataset.export_frames([[[self.corrected_frames]]])
   
-  def _postProcessSignal(self, signal_file, frames_per_second):
-    """Convert "frame" of signal output column to time format.
+  def _pickROI(self, collection, mouseevent, max_distance=5):
+    """Finds the ROI outline nearest to a click in :meth:`._plotROIs`.
+    
+    Used as the picker of the outlines' collection. A click is resolved
+    with one nearest-neighbour query of :meth:`._roiIndex`, rather than by
+    measuring the distance to every vertex of every ROI.
     
     Args:
-      signal_file (str): File containing signal data.
-      frames_per_second (float): Conversion factor in seconds per frame.
+      collection (matplotlib.collections.LineCollection): The outlines.
+      mouseevent (matplotlib.backend_bases.MouseEvent): The click.
+      max_distance (float, optional): Furthest a click can be from an
+        outline (in pixels of the image) to pick it.
+    Returns:
+      tuple: Whether an ROI was picked, and the properties of the pick
+      event; ``ind`` holds the index of the picked outline.
     
     """
-    # read in tab-separated data
-    data = read_csv(signal_file, sep='\t')
-    
-    # change name of 'frames' col to 'time'
-    old_cols = data.columns.tolist()
-    new_cols = [old_cols[0], 'time'] + old_cols[2:]
-    # preserve useless labels/tags in case they are someday useful
-    lab_tag = data['frame'].tolist()[:2]
-    
-    # cast frames from str to float so we can do math
-    times = map(float, data['frame'].tolist()[2:])
-    # convert frame number to time
-    times = map(lambda x: x / frames_per_second, times)
-    
-    # prepare new data for output
-    times = Series(lab_tag + times)
-    data['frame'] = times
-    data.columns = new_cols
-    
-    # export back to CSV
-    data.to_csv(signal_file, sep='\t')
+    if mouseevent.xdata is None or not self.rois:
+      return False, dict()
+    tree, owners = self._roiIndex()
+    distance, vertex = tree.query([mouseevent.xdata, mouseevent.ydata],
+                                  distance_upper_bound=max_distance)
+    if vertex == len(owners): # no vertex within max_distance
+      return False, dict()
+    return True, {'ind': [owners[vertex]]}
   
-  def _plotROIs(self, save_to=None, warn=False, draw=False, fig=None, ax=None, lines={}, ax_image=None, bleft=None, bright=None):
+  def _plotROIs(self, warn=False, draw=False, fig=None, ax=None, collection=None, ax_image=None, bleft=None, bright=None):
     """Plots ROIs against a background image with an applied rotation/flip
     
     Flipping is always performed first, then rotation. Rotation is in
     degrees clockwise, and must be a multiple of 90.
     
+    All ROI outlines are drawn as one
+    :class:`matplotlib.collections.LineCollection` (see
+    :meth:`._roiCollection`), so plotting cost barely grows with the number
+    of ROIs. Plots are shown interactively; see :meth:`._renderROIs` for
+    saving them to a file.
+    
     """
     
     def transform_generator(t, args):
@@ -584,63 +1507,47 @@ class SaraUI(CommandLineInterface):
       self._rotation -= 360
     
     # get list of ROIs
-    if self.dataset == None:
-      self.dataset = ImagingDataset.load(self.sima_dir)
+    self.load()
     if self.rois == None:
-      self.rois = self.dataset.ROIs['stICA ROIs']
-    
-    # prepare background image
-    # TODO: does this step work for multi-channel inputs?
-    imdata = self.dataset.time_averages[0, ..., -1]
-    # Perform flips
-    if self._hflip:
-      imdata = fliplr(imdata)
-    if self._vflip:
-      imdata = flipud(imdata)
-    # Perform rotation
-    if self._rotation:
-      k = self._rotation / 90
-      imdata = rot90(imdata, k)
-      
-    #image_width, image_height = image.size
-    image_width, image_height = imdata.shape
+      self.rois = self.dataset.ROIs[self.rois_label]
+    
+    # prepare background image; thumbnails of large frames are stretched
+    # over the full-resolution extent so ROI coordinates still line up
+    imdata, shape = self._background()
+    image_width, image_height = shape
+    extent = (-0.5, shape[1] - 0.5, shape[0] - 0.5, -0.5)
     ax.set_xlim(xmin=0, xmax=image_width)
     ax.set_ylim(ymin=0, ymax=image_height)
     if draw:
       ax_image.set_data(imdata)
+      ax_image.set_extent(extent)
       ax_image.set_cmap('gray')
       
     else:
-      ax_image = ax.imshow(imdata, cmap='gray')
-    
-    # plot all of the ROIs, warn user if an ROI has internal loops
-    for roi in self.rois:
-      coords = roi.coords
-      rid = roi.id
-      if warn and len(coords) > 1:
-        print "Warning: Roi%s has >1 coordinate set" % rid
-      x = coords[0][:,0]
-      y = coords[0][:,1]
-      # transform x and y
-      x, y = self._rotateFlipXY(
-               x, y, image_height, image_width, self._rotation,
-               self._hflip, self._vflip)
-      if save_to == None:
-        if draw:
-          lines[rid].set_data(x, y)
-        else:
-          lines[rid], = plt.plot(x, y, picker=line_picker_generator(rid))
-      else:
-        plt.plot(x, y)
+      ax_image = ax.imshow(imdata, cmap='gray', extent=extent)
+    
+    # warn user if an ROI has internal loops
+    if warn:
+      for roi in self.rois:
+        if len(roi.coords) > 1:
+          print "Warning: Roi%s has >1 coordinate set" % roi.id
+    
+    # plot all of the ROIs
+    rids, segments = self._roiCoords(image_height, image_width)
+    if draw:
+      collection.set_segments(segments)
+    else:
+      collection = self._roiCollection(segments)
+      collection.set_picker(self._pickROI)
+      ax.add_collection(collection)
     
     # build options for callback
     args = {
-      'save_to' : save_to,
       'warn'    : warn,
       'draw'    : True,
       'fig'     : fig,
       'ax'      : ax,
-      'lines'   : lines,
+      'collection' : collection,
       'ax_image': ax_image,
       'bleft'   : bleft,
       'bright'  : bright,
@@ -662,14 +1569,140 @@ class SaraUI(CommandLineInterface):
       bleft.on_clicked(transform_generator('left', args))
       bright.on_clicked(transform_generator('right', args))
     
-    if save_to != None:
-      plt.savefig(save_to)
+    if draw:
+      plt.draw()
     else:
-      if draw:
-        plt.draw()
-      else:
-        plt.gcf().canvas.mpl_connect('pick_event', onpick)
-        plt.show()
+      plt.gcf().canvas.mpl_connect('pick_event', onpick_generator(rids))
+      plt.show()
+  
+  def _renderROIs(self, save_to, warn=False):
+    """Saves a plot of ROIs against the background image, headlessly.
+    
+    Draws the same plot as :meth:`._plotROIs`, in the current orientation,
+    but on its own :class:`matplotlib.figure.Figure` with an Agg canvas:
+    no widgets are created and no pyplot state is used, so plots can be
+    rendered without a display and by many processes at once (see
+    :func:`render_plots`). If the ``plot_thumbnail_dpi`` setting is given,
+    a downscaled copy is also saved next to *save_to*, as
+    ``<name>_thumb.png``.
+    
+    Args:
+      save_to (str): Where to save the plot.
+      warn (bool, optional): Whether to print the IDs of ROIs with internal
+        loops.
+    
+    """
+    self._rotation %= 360
+    self.load()
+    if self.rois == None:
+      self.rois = self.dataset.ROIs[self.rois_label]
+    
+    imdata, shape = self._background()
+    image_width, image_height = shape
+    extent = (-0.5, shape[1] - 0.5, shape[0] - 0.5, -0.5)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.imshow(imdata, cmap='gray', extent=extent)
+    ax.set_xlim(xmin=0, xmax=image_width)
+    ax.set_ylim(ymin=0, ymax=image_height)
+    
+    if warn:
+      for roi in self.rois:
+        if len(roi.coords) > 1:
+          print "Warning: Roi%s has >1 coordinate set" % roi.id
+    segments = self._roiCoords(image_height, image_width)[1]
+    ax.add_collection(self._roiCollection(segments))
+    
+    with self._measure('savefig'):
+      fig.savefig(save_to)
+      dpi = self._setting('plot_thumbnail_dpi')
+      if dpi != None:
+        fig.savefig(splitext(save_to)[0] + '_thumb.png', dpi=float(dpi))
+  
+  def _reuseCorrection(self):
+    """Reuses the motion-corrected dataset of :meth:`.shareCorrection`'s SaraUI.
+    
+    A new dataset is created in :data:`sima_dir` from the other SaraUI's
+    (already corrected, already loaded) sequences, and its corrected frames
+    are linked to the corrected frames path. Its thumbnail is reused by
+    :meth:`._thumbnail` too, so the time averages aren't computed again.
+    
+    """
+    source = self._correction_source
+    print "Reusing motion correction from", source.sima_dir
+    stdout.flush()
+    self.sequence = source.sequence
+    self.dataset = ImagingDataset(source.dataset.sequences, self.sima_dir)
+    link_or_copy(source.corrected_frames, self.corrected_frames)
+    self._correction_reused = True
+  
+  def _roiCollection(self, segments):
+    """Returns ROI outlines as one line collection.
+    
+    Outlines are colored in turn from the color cycle chosen in
+    :meth:`.visualize`.
+    
+    Args:
+      segments (list): Outlines, as returned by :meth:`._roiCoords`.
+    Returns:
+      matplotlib.collections.LineCollection: The outlines.
+    
+    """
+    colors = [self._color_cycle[i % len(self._color_cycle)]
+              for i in xrange(len(segments))]
+    return LineCollection(segments, colors=colors, linewidths=self._linewidth)
+  
+  def _roiCoords(self, h, w):
+    """Returns the outlines of :data:`rois` in the current orientation.
+    
+    The outlines of all ROIs are packed into one array and transformed
+    with a single call to :meth:`._rotateFlipXY`, once per orientation.
+    Results are kept until :data:`rois` is replaced.
+    
+    Args:
+      h (int): background image height
+      w (int): background image width
+    Returns:
+      tuple: A list of ROI ids and a list of ``(points, 2)`` arrays of
+      ``x, y`` coordinates, one per ROI.
+    
+    """
+    if self._roi_coords_source is not self.rois:
+      outlines = [roi.coords[0][:, :2] for roi in self.rois]
+      xy = concatenate(outlines) if outlines else zeros((0, 2))
+      lengths = [len(outline) for outline in outlines]
+      owners = repeat(arange(len(outlines)), lengths)
+      self._roi_coords = {
+        None : ([roi.id for roi in self.rois], xy, cumsum(lengths)[:-1],
+                owners)
+      }
+      self._roi_coords_source = self.rois
+      self._roi_indexes = {}
+    key = (self._rotation, self._hflip, self._vflip)
+    if key not in self._roi_coords:
+      rids, xy, splits, owners = self._roi_coords[None]
+      x, y = self._rotateFlipXY(xy[:, 0], xy[:, 1], h, w, *key)
+      xy = column_stack([x, y])
+      self._roi_coords[key] = (rids, split(xy, splits), xy)
+    return self._roi_coords[key][:2]
+  
+  def _roiIndex(self):
+    """Returns a spatial index of the ROI outlines in the current orientation.
+    
+    A :class:`scipy.spatial.cKDTree` of every vertex of every outline
+    returned by :meth:`._roiCoords` is built once per orientation, and kept
+    until :data:`rois` is replaced.
+    
+    Returns:
+      tuple: The tree, and the index of the ROI (in :data:`rois`) that owns
+      each vertex in the tree.
+    
+    """
+    key = (self._rotation, self._hflip, self._vflip)
+    if key not in self._roi_indexes:
+      self._roi_indexes[key] = cKDTree(self._roi_coords[key][2])
+    return self._roi_indexes[key], self._roi_coords[None][3]
   
   def _rotateFlipXY(self, x, y, h, w, rotation=0, hflip=False, vflip=False):
     """Handles flipping and rotation of ``x`` and ``y`` arrays for plotting.
@@ -713,6 +1746,87 @@ class SaraUI(CommandLineInterface):
     
     return x, y
   
+  def _readScore(self, scores_file, settings, recording):
+    """Returns the last row :meth:`.score` wrote for *settings* and *recording*
+    
+    Numbers are converted back from text, and empty fields left out.
+    Returns ``None`` if *scores_file* has no such row.
+    
+    """
+    row = None
+    with directory_lock(scores_file + '.lock'):
+      with open(scores_file) as fh:
+        for entry in csv.DictReader(fh):
+          if entry['settings'] == settings \
+          and entry['recording'] == recording:
+            row = entry
+    if row == None:
+      return None
+    for field in SCORE_FIELDS[2:]:
+      if row.get(field, '') == '':
+        row.pop(field, None)
+      elif field in ['rois', 'frames', 'looped_rois']:
+        row[field] = int(row[field])
+      else:
+        row[field] = float(row[field])
+    return row
+  
+  def _recordStage(self, stage, inputs, settings, outputs=[]):
+    """Writes a completion manifest for a pipeline stage.
+    
+    The manifest is stored in :data:`sima_dir` and read back by
+    :meth:`._stageComplete`. See :meth:`._stageComplete` for arguments.
+    
+    """
+    manifest = {
+      'inputs'    : inputs,
+      'settings'  : settings,
+      'outputs'   : [abspath(o) for o in outputs],
+      'completed' : time(),
+    }
+    with open(self._stagePath(stage), 'w') as fh:
+      dump(manifest, fh, sort_keys=True, default=str)
+  
+  def _setting(self, name, default=None):
+    """Returns a setting from :data:`settings_file`, or *default* if unset"""
+    if self.settings is None or name not in self.settings:
+      return default
+    value = self.settings[name]
+    if isinstance(value, float) and isnan(value):
+      return default
+    return value
+  
+  def _settingsName(self):
+    """Returns the name of the settings used to find :data:`rois`
+    
+    This is the ``settings_name`` setting if there is one (see
+    :meth:`settings_space.SettingsSpace.settings`), or else the base name
+    of :data:`settings_file`. For ROIs found by :meth:`.segmentSweep`, it is
+    the name of that combination's settings file.
+    
+    """
+    prefix = sweep_label('')
+    if self.rois_label.startswith(prefix) and self.rois_label != prefix:
+      return self.rois_label[len(prefix):]
+    return self._setting('settings_name', basename(self.settings_file))
+  
+  def _sharedCorrection(self, input_path):
+    """Returns the correction that :meth:`.shareCorrection` made available
+    
+    Returns:
+      dict: The input path, its :func:`file_digest` (``None`` if it wasn't
+      hashed) and the key (see :meth:`._mcCacheKey`) of the other SaraUI's
+      correction, or ``None`` if there is no other SaraUI, it hasn't
+      loaded or computed a correction, or it corrected a different file.
+    
+    """
+    source = self._correction_source
+    if source == None or source.dataset == None or source._correction == None:
+      return None
+    if source._correction['input'] != abspath(input_path):
+      return None
+    return source._correction
+  
   def _showRadio(self, label, options, default=None):
     """Displays a radio button"""
     if default == None:
@@ -722,6 +1836,155 @@ class SaraUI(CommandLineInterface):
     display(radio)
     return radio
   
+  def _signalLabel(self):
+    """Returns the label signals extracted from :data:`rois` are stored as"""
+    if self.rois_label == 'stICA ROIs':
+      return 'signal'
+    return self.rois_label + ' signal'
+  
+  def _stICA(self, segment_settings, label='stICA ROIs'):
+    """Segments :data:`dataset` with :class:`sima.segment.STICA`.
+    
+    The resulting ROIs become :data:`rois` and are stored in the dataset
+    under *label*. SIMA keeps the PCA results in :data:`sima_dir`, so
+    repeated calls on the same dataset only pay for the PCA step once per
+    number of components.
+    
+    Args:
+      segment_settings (dict): *components*, *mu* and *overlap_per*
+        parameters to pass to :class:`sima.segment.STICA`.
+      label (str, optional): Label to store the ROIs under.
+    
+    """
+    print "Performing Spatiotemporal Independent Component Analysis..."
+    stdout.flush()
+    stica = STICA(**segment_settings)
+    stica.append(IdROIs())
+    self.load()
+    self.rois_label = label
+    with self._measure('segment', segment_settings['components']):
+      self.rois = self.dataset.segment(stica, label=label)
+    print len(self.dataset.ROIs[label]), "ROIs found"
+    # a new segment manifest makes signals extracted from the ROIs this
+    # label used to have obsolete (see _extract)
+    self._recordStage('segment', self._stageInputs('motionCorrect'),
+                      segment_settings)
+  
+  def _stageComplete(self, stage, inputs, settings, outputs=[]):
+    """Checks whether a pipeline stage has already been completed.
+    
+    A stage is complete if its manifest in :data:`sima_dir` was recorded
+    with the same inputs, settings and outputs, and every output still
+    exists. Stages run against the ROIs in :data:`rois_label`, so each ROI
+    label gets its own manifests.
+    
+    Args:
+      stage (str): Name of the stage, e.g. ``"segment"``.
+      inputs (str): Digest of the stage's inputs. ``None`` means the inputs
+        are unknown, in which case the stage is never skipped.
+      settings (dict): Settings that affect the stage's results.
+      outputs (list, optional): Files the stage writes.
+    Returns:
+      bool: ``True`` if the stage can be skipped.
+    
+    """
+    path = self._stagePath(stage)
+    if inputs == None or not isfile(path):
+      return False
+    with open(path) as fh:
+      manifest = load(fh)
+    outputs = [abspath(o) for o in outputs]
+    # round-trip settings through JSON so that tuples, etc. compare equal
+    settings = loads(dumps(settings, default=str))
+    return manifest['inputs'] == inputs \
+           and manifest['settings'] == settings \
+           and manifest['outputs'] == outputs \
+           and all(isfile(o) for o in outputs)
+  
+  def _stageInputs(self, stage):
+    """Returns a digest of *stage*'s manifest, or ``None`` if there isn't one
+    
+    Used as the inputs of the stages that follow *stage*; because manifests
+    record when they were written, re-running *stage* invalidates every
+    stage after it.
+    
+    """
+    path = self._stagePath(stage)
+    if not isfile(path):
+      return None
+    return file_digest(path)
+  
+  def _stagePath(self, stage):
+    """Returns the path of the completion manifest for *stage*"""
+    if stage != 'motionCorrect' and self.rois_label != 'stICA ROIs':
+      stage += '_' + self.rois_label.replace(' ', '_')
+    return path_join(self.sima_dir, 'sara_%s.json' % stage)
+  
+  def _storeCachedCorrection(self, cache_dir, key):
+    """Adds the current motion-corrected dataset to the cache.
+    
+    The dataset and frames are written under temporary names and then
+    renamed into place, so concurrent jobs never see a partial cache entry.
+    If another job stored the same entry first, ours is discarded.
+    
+    Args:
+      cache_dir (str): Directory containing the motion-correction cache.
+      key (str): Cache key generated by :meth:`._mcCacheKey`.
+    
+    """
+    if not isdir(cache_dir):
+      try:
+        makedirs(cache_dir)
+      except OSError:
+        pass # created by a concurrent job
+    cached_dir = path_join(cache_dir, key + '.sima')
+    cached_frames = path_join(cache_dir, key + '.tif')
+    tmp_name = "%s.%d.tmp" % (key, getpid())
+    tmp_dir = path_join(cache_dir, tmp_name + '.sima')
+    tmp_frames = path_join(cache_dir, tmp_name + '.tif')
+    link_or_copy(self.corrected_frames, tmp_frames)
+    ImagingDataset(self.dataset.sequences, tmp_dir)
+    rename(tmp_frames, cached_frames)
+    try:
+      rename(tmp_dir, cached_dir)
+    except OSError:
+      rmtree(tmp_dir)
+  
+  def _thumbnail(self):
+    """Returns the time average of :data:`dataset`, downsampled for plotting.
+    
+    Frames larger than the ``thumbnail_size`` setting (default 1024 pixels)
+    along either axis are block-averaged with :func:`bin_frame` to fit. The
+    thumbnail is stored in :data:`sima_dir` as ``sara_thumbnail.npz`` and
+    reused by later sessions until motion correction is repeated.
+    
+    Returns:
+      tuple: The thumbnail and the ``(rows, columns)`` shape of
+      full-resolution frames.
+    
+    """
+    path = path_join(self.sima_dir, 'sara_thumbnail.npz')
+    source = str(self._stageInputs('motionCorrect'))
+    if isfile(path):
+      cached = load_array(path)
+      if str(cached['source']) == source:
+        return cached['image'], tuple(cached['shape'])
+    if self._correction_reused:
+      # same frames as the SaraUI the correction came from
+      image, shape = self._correction_source._thumbnail()
+    else:
+      # TODO: does this step work for multi-channel inputs?
+      imdata = self.dataset.time_averages[0, ..., -1]
+      size = int(self._setting('thumbnail_size', 1024))
+      spatial_bin = max(1, -(-max(imdata.shape) // size))
+      image = bin_frame(imdata, spatial_bin).astype(float32)
+      shape = imdata.shape
+    # write under a temporary name; several processes may be plotting
+    tmp_path = path_join(self.sima_dir, 'sara_thumbnail.%d.npz' % getpid())
+    savez(tmp_path, image=image, shape=shape, source=source)
+    rename(tmp_path, path)
+    return image, shape
+  
   def _updateSettingsFile(self, new_settings):
     if isfile(self.settings_file):
       old_settings = Series.from_csv(self.settings_file)
@@ -734,11 +1997,110 @@ class SaraUI(CommandLineInterface):
       old_settings = Series(new_settings)
     old_settings.to_csv(self.settings_file)
   
+  def _writeSignals(self, outfile, frames_per_second=None, block=4096):
+    """Writes :data:`signal` to a tab-separated file in a single pass.
+    
+    The layout matches :meth:`sima.ImagingDataset.export_signals`: a row of
+    ROI ids, a row of ROI labels and a row of ROI tags, followed by one row
+    per frame. If *frames_per_second* is given, the frame column is
+    replaced by a time column (in seconds), computed for a whole block of
+    frames at once.
+    
+    Args:
+      outfile (str): Where to write the signals.
+      frames_per_second (float, optional): Capture rate used to convert
+        frame numbers to times.
+      block (int, optional): Number of frames to format at a time.
+    
+    """
+    rois = self.signal['rois']
+    frame_label = 'frame' if frames_per_second == None else 'time'
+    frame_fmt = '%d' if frames_per_second == None else '%.10g'
+    fmt = ['%d', frame_fmt] + ['%.10g'] * len(rois)
+    with open(outfile, 'wb') as fh:
+      writer = csv.writer(fh, delimiter='\t')
+      writer.writerow(['sequence', frame_label] + [r['id'] for r in rois])
+      writer.writerow(['', 'label'] + [r['label'] for r in rois])
+      writer.writerow(['', 'tags'] + [','.join(sorted(r['tags']))
+                                      for r in rois])
+      for sequence_idx, raw in enumerate(self.signal['raw']):
+        num_frames = raw.shape[1]
+        for start in xrange(0, num_frames, block):
+          stop = min(start + block, num_frames)
+          times = arange(start, stop)
+          if frames_per_second != None:
+            times = times / frames_per_second
+          rows = column_stack([full(stop - start, sequence_idx), times,
+                               raw[:, start:stop].T])
+          savetxt(fh, rows, fmt=fmt, delimiter='\t')
+  
+  def _writeSignalsBinary(self, outfile, frames_per_second=None):
+    """Writes :data:`signal` to a binary ``.npz`` or ``.npy`` file.
+    
+    Signals from all sequences are stored as one float32 array of shape
+    ``(num_rois, num_frames)``, alongside arrays of ROI ids and labels and
+    the sequence, frame and (if *frames_per_second* is given) time of
+    every column:
+    
+    * ``.npz`` files hold everything in one compressed archive, loaded with
+      :func:`numpy.load`.
+    * ``.npy`` files hold only the signal array, so it can be memory-mapped
+      with ``numpy.load(outfile, mmap_mode='r')``. The other arrays are
+      stored next to it in ``<name>_meta.npz``.
+    
+    Args:
+      outfile (str): Where to write the signals; must end in ``.npz`` or
+        ``.npy``.
+      frames_per_second (float, optional): Capture rate used to convert
+        frame numbers to times.
+    
+    """
+    raw = self.signal['raw']
+    rois = self.signal['rois']
+    metadata = {
+      'roi_ids'    : array([r['id'] for r in rois]),
+      'roi_labels' : array([str(r['label']) for r in rois]),
+      'sequence'   : concatenate([full(r.shape[1], i, dtype=int)
+                                  for i, r in enumerate(raw)]),
+      'frame'      : concatenate([arange(r.shape[1]) for r in raw]),
+    }
+    if frames_per_second != None:
+      metadata['time'] = metadata['frame'] / frames_per_second
+    
+    if outfile.endswith('.npz'):
+      signals = concatenate([r.astype(float32) for r in raw], axis=1)
+      savez_compressed(outfile, signals=signals, **metadata)
+    else:
+      # fill a memory-mapped file one sequence at a time
+      shape = (len(rois), len(metadata['frame']))
+      signals = open_memmap(outfile, mode='w+', dtype=float32, shape=shape)
+      start = 0
+      for r in raw:
+        signals[:, start:start + r.shape[1]] = r
+        start += r.shape[1]
+      signals.flush()
+      del signals
+      savez(splitext(outfile)[0] + '_meta.npz', **metadata)
+  
   def exportSignal(self, outfile=None, use_settings=False):
     """Write ROI signals to a file.
     
-    Uses settings from :data:`signal_radio` or (if *use_settings* is True)
-    :data:`settings_file`.
+    Uses settings from :data:`signal_radio` and :data:`export_radio` or
+    (if *use_settings* is True) :data:`settings_file`.
+    
+    Signals are written as tab-separated text by default. Setting
+    ``signals_export_format`` to ``npz`` or ``npy`` writes a binary file
+    instead, which is much faster to write and load for long recordings
+    (see :meth:`._writeSignalsBinary`). The extension of *outfile* is
+    replaced to match binary formats.
+    
+    Signals are extracted by :meth:`._extract`; if the settings file has
+    an ``extraction_block_frames`` entry greater than zero, they are
+    extracted in blocks of that many frames.
+    
+    If the settings file has a ``signals_store`` entry, the signals are
+    also added to that :class:`signal_store.SignalStore`, under the
+    settings file's name and the name of :data:`sima_dir`.
     
     Args:
       outfile (str, optional): where to store signal; if None or omitted,
@@ -749,19 +2111,32 @@ class SaraUI(CommandLineInterface):
     """
     
     frames_per_second = None
-    # initialize dataset and rois
-    if self.rois == None:
-      if self.dataset == None:
-        self.dataset = ImagingDataset.load(self.sima_dir)
-      self.rois = self.dataset.ROIs['stICA ROIs']
     # prompt user for export path if it hasn't already been provided
     if outfile == None:
       prompt = "File path to export to: "
       outfile = self.reserveFilePath(prompt)
+    if use_settings:
+      export_format = self._setting('signals_export_format', 'csv')
+    else:
+      export_format = self.export_radio.value
+      self.export_radio.close()
+    if export_format != 'csv':
+      outfile = splitext(outfile)[0] + '.' + export_format
+    # skip export if a previous run already completed it
+    if use_settings:
+      stage_settings = {
+        'signals_format'        : self.settings['signals_format'],
+        'frames_per_second'     : self._setting('frames_per_second'),
+        'signals_export_format' : export_format,
+      }
+      if self._stageComplete('exportSignal', self._stageInputs('segment'),
+                             stage_settings, [outfile]):
+        print "Signal export already complete, skipping"
+        return
     # get the frames-per-second conversion factor
     if use_settings and self.settings['signals_format'] == 'time':
       frames_per_second = float(self.settings['frames_per_second'])
-    elif self.signal_radio.value == 'time':
+    elif not use_settings and self.signal_radio.value == 'time':
       prompt = "Please input the recording's capture rate " + \
                "(frames per second): "
       while frames_per_second <= 0:
@@ -769,18 +2144,28 @@ class SaraUI(CommandLineInterface):
         prompt = "The number you entered is not a valid capture rate" + \
                  ", please try again: "
       self.signal_radio.close()
-    # check if we've already extracted a signal
-    if self.dataset.signals() == {}:
-      print "Extracting signals from ROIs..."
-      stdout.flush() # force print statement to output to IPython
-      self.signal = self.dataset.extract(rois=self.rois, label='signal')
-      print "Signals extracted"
-    else:
-      self.signal = self.dataset.signals()['signal']
-    self.dataset.export_signals(outfile)
-    # do we need to post-process the CSV?
-    if frames_per_second != None:
-      self._postProcessSignal(outfile, frames_per_second)
+    # extract signals unless we already have them for these ROIs
+    self._extract()
+    with self._measure('exportSignal'):
+      if export_format == 'csv':
+        self._writeSignals(outfile, frames_per_second)
+      else:
+        self._writeSignalsBinary(outfile, frames_per_second)
+    # add signals to the sweep's signal store as soon as they are ready
+    store_path = self._setting('signals_store')
+    if store_path != None:
+      recording = basename(abspath(self.sima_dir))
+      if recording.endswith('.sima'):
+        recording = recording[:-len('.sima')]
+      rois = self.signal['rois']
+      with self._measure('storeSignals'):
+        SignalStore(store_path).add(
+          self._settingsName(), recording, [r['id'] for r in rois],
+          list(self.signal['raw']), [r['label'] for r in rois],
+          frames_per_second)
+    if use_settings:
+      self._recordStage('exportSignal', self._stageInputs('segment'),
+                        stage_settings, [outfile])
     
     # update settings file unless it's unnecessary
     if not use_settings:
@@ -788,6 +2173,7 @@ class SaraUI(CommandLineInterface):
         'signals_file'      : abspath(outfile),
         'signals_format'    : self.signal_radio.value,
         'frames_per_second' : frames_per_second,
+        'signals_export_format' : export_format,
       }
       self._updateSettingsFile(signal_settings)
     print "Signals Exported to", outfile
@@ -826,12 +2212,51 @@ class SaraUI(CommandLineInterface):
     image_path = self.getFileWithExtension(prompt, extension)
     return image_path
   
+  def load(self):
+    """Loads the motion-corrected dataset in :data:`sima_dir`.
+    
+    The dataset is loaded once and kept in :data:`dataset`, so that
+    :meth:`.segment`, :meth:`.visualize` and :meth:`.exportSignal` can be
+    called repeatedly, with different settings, without reloading it or
+    repeating motion correction. SIMA stores the time averages and the
+    STICA PCA results in :data:`sima_dir`, so those are only computed the
+    first time too.
+    
+    Example:
+      Re-segmenting an existing analysis directory in the notebook::
+        
+        ui = sara.SaraUI('mydir.sima', 'settings.csv')
+        ui.load()
+        ui.segment()
+        ui.exportSignal()
+    
+    Returns:
+      list: Labels of the ROIs already stored in the dataset.
+    
+    """
+    if self.dataset == None:
+      with self._measure('load'):
+        self.dataset = ImagingDataset.load(self.sima_dir)
+    if self.sequence == None:
+      self.sequence = self.dataset.sequences[0]
+    return self.dataset.ROIs.keys()
+  
   def motionCorrect(self, input_path=None, output_path=None, use_settings=False):
     """Perform motion correction on a recording and export frames.
     
     Uses settings from :data:`mc_radio` or (if *use_settings* is True)
     :data:`settings_file`. 
     
+    If the settings file contains an ``input_cache_dir`` entry, the input
+    is converted to HDF5 there (see :meth:`._inputSequence`), so that it
+    is read one frame at a time rather than loaded whole.
+    
+    If the settings file contains an ``mc_cache_dir`` entry, corrections
+    are stored in (and reused from) that directory, keyed by the contents
+    of *input_path*, the correction strategy and the maximum displacement.
+    Sweep jobs that share those settings then only correct each recording
+    once.
+    
     Args:
       input_path (str, optional) : File path to the image to be corrected.
         If None, user is prompted for location.
@@ -841,13 +2266,12 @@ class SaraUI(CommandLineInterface):
         :data:`settings_file`. If False, user is prompted for settings.
     
     """
-    # sima uses the builtin input() function, which is not compatible with IPython
-    if isdir(self.sima_dir):
-      if ipython_loaded():
-        msg = "You cannot perform motion correction using an" + \
-              " existing SIMA analysis directory"
-        warnings.warn(msg)
-        return # exit before we screw something up
+    # sima uses the builtin input() function, which is not compatible with
+    # IPython, to ask before overwriting; reuse the existing dataset instead
+    if isdir(self.sima_dir) and ipython_loaded():
+      print "Using the existing motion-corrected dataset in", self.sima_dir
+      self.load()
+      return
      
     if input_path == None:
       # currently only TIFF is supported by SARA
@@ -860,7 +2284,6 @@ class SaraUI(CommandLineInterface):
     else:
       self.corrected_frames = output_path
     
-    self.sequence = Sequence.create('TIFF', input_path)
     if use_settings:
       md_x = int(self.settings['max_displacement_x'])
       md_y = int(self.settings['max_displacement_y'])
@@ -873,12 +2296,58 @@ class SaraUI(CommandLineInterface):
     
     if use_settings:
       strategy = self.settings['correction_strategy']
-      self._motion_correction_map[strategy](mc_settings)
     else:
       # By this time, the user should have selected a strategy
       self.strategy_radio.close()
-      self._motion_correction_map[self.strategy_radio.value](mc_settings)
-      
+      strategy = self.strategy_radio.value
+    
+    # skip motion correction if a previous run already completed it
+    cache_dir = self._setting('mc_cache_dir')
+    shared = self._sharedCorrection(input_path)
+    input_digest = None
+    if shared != None and shared['digest'] != None:
+      input_digest = shared['digest']
+    elif use_settings or cache_dir != None:
+      input_digest = file_digest(input_path)
+    # without a digest, the input is identified by its path, size and time
+    if input_digest != None:
+      identity = input_digest
+    else:
+      info = stat(input_path)
+      identity = '%s:%d:%r' % (abspath(input_path), info.st_size,
+                               info.st_mtime)
+    key = self._mcCacheKey(identity, strategy, [md_x, md_y])
+    stage_settings = {
+      'correction_strategy' : strategy,
+      'max_displacement'    : [md_x, md_y],
+    }
+    outputs = [self.corrected_frames]
+    if use_settings and self._stageComplete('motionCorrect', input_digest,
+                                             stage_settings, outputs):
+      print "Motion correction already complete, skipping"
+      return
+    
+    # reuse an identical correction from another job if possible; the input
+    # is only read (and converted) if it has to be corrected here
+    with self._measure('motionCorrect'):
+      if shared != None and shared['key'] == key:
+        self._reuseCorrection()
+      elif cache_dir != None and self._loadCachedCorrection(cache_dir, key):
+        self.sequence = self.dataset.sequences[0]
+      else:
+        self.sequence = self._inputSequence(input_path, input_digest)
+        self._motion_correction_map[strategy](mc_settings)
+        if cache_dir != None:
+          self._storeCachedCorrection(cache_dir, key)
+    self._recordStage('motionCorrect', input_digest, stage_settings, outputs)
+    # what other SaraUIs may reuse (see shareCorrection)
+    self._correction = {
+      'input'  : abspath(input_path),
+      'digest' : input_digest,
+      'key'    : key,
+    }
+    
+    if not use_settings:
       # export settings we used to settings file
       mc_settings = {
         'uncorrected_image'   : abspath(input_path),
@@ -889,6 +2358,230 @@ class SaraUI(CommandLineInterface):
       }
       self._updateSettingsFile(mc_settings)
   
+  def preview(self, input_path=None, spatial_bin=None, frame_step=None,
+              use_settings=False):
+    """Runs the pipeline on a reduced copy of a recording for quick tuning.
+    
+    The recording is read one frame at a time, keeping every
+    *frame_step*-th frame and averaging *spatial_bin* x *spatial_bin*
+    blocks of pixels. The reduced copy is then motion-corrected, segmented
+    and visualized in a separate ``<name>_preview.sima`` directory, which
+    takes seconds rather than minutes. Maximum displacements are scaled
+    down by *spatial_bin*.
+    
+    Unless *use_settings* is True, the user is prompted for the same
+    settings as :meth:`.motionCorrect` and :meth:`.segment`, and the
+    full-resolution equivalents are saved to :data:`settings_file`. Once
+    the preview looks right, :meth:`.replay` runs motion correction and
+    segmentation on the full recording with those settings.
+    
+    Args:
+      input_path (str, optional): File path to the TIFF stack. If None,
+        the user is prompted for location.
+      spatial_bin (int, optional): Width and height of the blocks of pixels
+        to average. If None, the ``preview_spatial_bin`` setting is used,
+        or the user is prompted (default 2).
+      frame_step (int, optional): Keep one frame in this many. If None,
+        the ``preview_frame_step`` setting is used, or the user is prompted
+        (default 4).
+      use_settings (bool, optional): Whether to use the settings stored in
+        :data:`settings_file`. If False, user is prompted for settings.
+    Returns:
+      SaraUI: The interface used for the preview, e.g. to visualize again.
+    
+    """
+    if use_settings:
+      if input_path == None:
+        input_path = self.settings['uncorrected_image']
+      if spatial_bin == None:
+        spatial_bin = int(self._setting('preview_spatial_bin', 2))
+      if frame_step == None:
+        frame_step = int(self._setting('preview_frame_step', 4))
+      md_x = int(self.settings['max_displacement_x'])
+      md_y = int(self.settings['max_displacement_y'])
+      strategy = self.settings['correction_strategy']
+      segment_settings = {
+        'components' : int(self.settings['components']),
+        'mu' : float(self.settings['mu']),
+        'overlap_per' : float(self.settings['overlap_per']),
+      }
+    else:
+      if input_path == None:
+        prompt = "File path to the image you want to preview (TIFF only): "
+        input_path = self.getTIFF(prompt)
+      if spatial_bin == None:
+        prompt = "Pixels to bin along each axis (default 2): "
+        spatial_bin = max(1, self.getNatural(prompt, default=2))
+      if frame_step == None:
+        prompt = "Keep one frame in how many? (default 4): "
+        frame_step = max(1, self.getNatural(prompt, default=4))
+      prompt = ["Maximum %s displacement (in pixels; default 100): " \
+                 % ax for ax in ['X', 'Y']]
+      md_x = self.getNatural(prompt[0], default=100)
+      md_y = self.getNatural(prompt[1], default=100)
+      strategy = self.strategy_radio.value
+      prompt = "Number of PCA components (default 50): "
+      components = self.getNatural(prompt, default=50)
+      prompt = "mu (default 0.5): "
+      mu = -1.0
+      while mu < 0 or mu > 1:
+        mu = self.getFloat(prompt, default=0.5)
+      prompt = "Minimum overlap " + \
+               "(default 20%; enter 0 to skip): "
+      overlap_per = self.getPercent(prompt, default=0.2)
+      segment_settings = {
+        'components' : components,
+        'mu' : mu,
+        'overlap_per' : overlap_per,
+      }
+    
+    # build the reduced recording
+    print "Reducing recording for preview . . ."
+    stdout.flush()
+    frames = [bin_frame(frame, spatial_bin) for t, frame
+              in enumerate(tiff_frames(input_path)) if t % frame_step == 0]
+    data = array(frames, dtype=float32)[:, None, :, :, None]
+    
+    # run the same stages in a scratch directory
+    name = self.sima_dir[:-len('.sima')] if self.sima_dir.endswith('.sima') \
+           else self.sima_dir
+    preview_dir = name + '_preview.sima'
+    if isdir(preview_dir):
+      rmtree(preview_dir)
+    settings = Series() if self.settings is None else self.settings.copy()
+    ui = SaraUI(preview_dir, self.settings_file, settings)
+    ui._rotation, ui._hflip, ui._vflip = \
+      self._rotation, self._hflip, self._vflip
+    ui.sequence = Sequence.create('ndarray', data)
+    ui.corrected_frames = name + '_preview.tif'
+    max_displacement = [md_x // spatial_bin, md_y // spatial_bin]
+    ui._motion_correction_map[strategy]({'max_displacement':
+                                         max_displacement})
+    preview_settings = dict(segment_settings)
+    preview_settings['components'] = min(segment_settings['components'],
+                                         len(frames) - 1)
+    ui._stICA(preview_settings)
+    ui.visualize(use_settings=use_settings)
+    
+    if not use_settings:
+      # save the full-resolution equivalents of the settings we previewed
+      full_settings = {
+        'uncorrected_image'   : abspath(input_path),
+        'max_displacement_x'  : md_x,
+        'max_displacement_y'  : md_y,
+        'correction_strategy' : strategy,
+        'segmentation_strategy' : 'stICA',
+        'preview_spatial_bin' : spatial_bin,
+        'preview_frame_step'  : frame_step,
+      }
+      full_settings.update(segment_settings)
+      self._updateSettingsFile(full_settings)
+    return ui
+  
+  def replay(self, input_path=None, output_path=None):
+    """Runs full-resolution motion correction and segmentation.
+    
+    Reloads :data:`settings_file` (e.g. as saved by :meth:`.preview`) and
+    runs :meth:`.motionCorrect` and :meth:`.segment` with it. Visualize
+    and export signals as usual afterwards.
+    
+    Args:
+      input_path (str, optional): File path to the image to be corrected.
+        If None, the ``uncorrected_image`` setting is used.
+      output_path (str, optional): File path to export corrected frames. If
+        None, user is prompted for location.
+    
+    """
+    self.settings = Series.from_csv(self.settings_file)
+    if input_path == None:
+      input_path = self.settings['uncorrected_image']
+    self.motionCorrect(input_path, output_path, use_settings=True)
+    self.segment(use_settings=True)
+  
+  def score(self, scores_file=None):
+    """Scores the segmentation in :data:`rois` and records a summary row.
+    
+    Computes, for all ROIs at once, their mask areas (in pixels), their
+    compactness (:math:`4 \pi A / P^2` of the outline; 1 for a circle),
+    how many have internal loops, the signal-to-noise ratio of each trace,
+    and the correlation between every pair of traces (see
+    :func:`trace_statistics`, which reads signals in blocks, so scoring
+    memory-mapped signals stays within bounded memory). One row of summary
+    statistics (see :data:`SCORE_FIELDS`) is appended to *scores_file*, so
+    the results of a whole sweep can be ranked without reading their
+    signals again. Signals are extracted first if needed (see
+    :meth:`._extract`).
+    
+    Scoring is recorded as a stage that depends on :meth:`.exportSignal`.
+    If the signals haven't been exported again since they were scored, the
+    row is read back from *scores_file* instead of being computed and
+    appended again.
+    
+    Args:
+      scores_file (str, optional): CSV file to append the row to. Defaults
+        to the ``scores_file`` setting, or ``sara_scores.csv`` in
+        :data:`sima_dir`. Concurrent jobs can share one file.
+    Returns:
+      dict: The summary row.
+    
+    """
+    if scores_file == None:
+      scores_file = self._setting('scores_file',
+                                  path_join(self.sima_dir, 'sara_scores.csv'))
+    recording = basename(abspath(self.sima_dir))
+    if recording.endswith('.sima'):
+      recording = recording[:-len('.sima')]
+    settings_name = self._settingsName()
+    inputs = self._stageInputs('exportSignal')
+    stage_settings = {'scores_file' : abspath(scores_file)}
+    if self._stageComplete('score', inputs, stage_settings, [scores_file]):
+      row = self._readScore(scores_file, settings_name, recording)
+      if row != None:
+        print "Scoring already complete, skipping"
+        return row
+    
+    self._extract()
+    raw = list(self.signal['raw'])
+    row = {
+      'settings'  : settings_name,
+      'recording' : recording,
+      'rois'      : len(self.rois),
+      'frames'    : sum(r.shape[1] for r in raw),
+    }
+    block_frames = int(self._setting('extraction_block_frames', 0)) or 4096
+    with self._measure('score'):
+      if len(self.rois):
+        masks = roi_mask_matrix(self.rois, self.dataset.frame_shape[:3])
+        pixels = diff(masks.indptr)
+        outline_area, perimeter, loops = roi_shapes(self.rois)
+        with errstate(invalid='ignore', divide='ignore'):
+          compactness = 4 * pi * outline_area / perimeter ** 2
+        compactness = compactness[isfinite(compactness)]
+        row['area_mean'] = pixels.mean()
+        row['area_median'] = median(pixels)
+        if len(compactness):
+          row['compactness_median'] = median(compactness)
+        row['looped_rois'] = int((loops > 1).sum())
+      snr, correlation = trace_statistics(raw, block_frames)
+      if len(snr):
+        row['snr_mean'] = snr.mean()
+        row['snr_median'] = median(snr)
+      if correlation is not None:
+        pairs = correlation[~eye(len(correlation), dtype=bool)]
+        if isfinite(pairs).any():
+          row['correlation_mean'] = nanmean(pairs)
+          row['correlation_max'] = nanmax(pairs)
+    
+    with directory_lock(scores_file + '.lock'):
+      new_file = not isfile(scores_file)
+      with open(scores_file, 'ab') as fh:
+        writer = csv.DictWriter(fh, SCORE_FIELDS)
+        if new_file:
+          writer.writeheader()
+        writer.writerow(row)
+    self._recordStage('score', inputs, stage_settings, [scores_file])
+    return row
+  
   def segment(self, use_settings=False):
     """Performs Spatiotemporal Independent Component Analysis.
     
@@ -906,10 +2599,12 @@ class SaraUI(CommandLineInterface):
       mu = float(self.settings['mu'])
       overlap_per = float(self.settings['overlap_per'])
     else:
-      if self.sequence == None:
+      if self.dataset == None and isdir(self.sima_dir):
+        self.load()
+      elif self.sequence == None:
         prompt = "File path to the image you want to segment (TIFF only): "
         input_path = self.getTIFF(prompt)
-        self.sequence = Sequence.create('TIFF', input_path)
+        self.sequence = self._inputSequence(input_path)
         self.dataset = ImagingDataset([self.sequence], self.sima_dir)
       prompt = "Number of PCA components (default 50): "
       components = self.getNatural(prompt, default=50)
@@ -925,19 +2620,87 @@ class SaraUI(CommandLineInterface):
       'mu' : mu,
       'overlap_per' : overlap_per,
     }
-    print "Performing Spatiotemporal Independent Component Analysis..."
-    stdout.flush()
-    stica = STICA(**segment_settings)
-    stica.append(IdROIs())
-    if self.dataset == None:
-      self.dataset = ImagingDataset.load(self.sima_dir)
-    self.rois = self.dataset.segment(stica, label="stICA ROIs")
-    print len(self.dataset.ROIs['stICA ROIs']), "ROIs found"
+    self.rois_label = 'stICA ROIs'
+    if use_settings and self._stageComplete(
+         'segment', self._stageInputs('motionCorrect'), segment_settings):
+      print "Segmentation already complete, skipping"
+      self.rois = None # loaded when needed
+      return
+    self._stICA(segment_settings)
     
     if not use_settings:
       segment_settings['segmentation_strategy'] = 'stICA'
       self._updateSettingsFile(segment_settings)
   
+  def segmentSweep(self, settings_files):
+    """Segments the dataset once for every settings file in a sweep.
+    
+    Each settings file contributes a (*components*, *mu*, *overlap_per*)
+    combination, which is stored as its own ROI label in :data:`sima_dir`
+    (see :func:`sweep_label`). The dataset is loaded once, and combinations
+    are run grouped by *components*, largest first, so that the PCA step
+    is shared by every combination with the same number of components.
+    
+    Args:
+      settings_files (list): Paths to settings files, as generated by
+        ``autogen_settings.py``, or settings generated by
+        :meth:`settings_space.SettingsSpace.settings`.
+    Returns:
+      dict: Maps the name of each settings file to its ROI label.
+    
+    """
+    self.load()
+    sweep = []
+    for settings_file in settings_files:
+      if isinstance(settings_file, Series):
+        settings, name = settings_file, settings_file['settings_name']
+      else:
+        settings = Series.from_csv(settings_file)
+        name = basename(settings_file)
+      segment_settings = {
+        'components' : int(settings['components']),
+        'mu' : float(settings['mu']),
+        'overlap_per' : float(settings['overlap_per']),
+      }
+      sweep.append((segment_settings, name))
+    sweep.sort(key=lambda s: -s[0]['components'])
+    
+    labels = {}
+    inputs = self._stageInputs('motionCorrect')
+    for segment_settings, name in sweep:
+      labels[name] = sweep_label(name)
+      self.rois_label = labels[name]
+      if self._stageComplete('segment', inputs, segment_settings):
+        print "Segmentation with", name, "already complete, skipping"
+        continue
+      print "Segmenting with", name
+      self._stICA(segment_settings, labels[name])
+    self.rois = None
+    return labels
+  
+  def shareCorrection(self, ui):
+    """Lets :meth:`.motionCorrect` reuse another SaraUI's correction.
+    
+    Meant for long-lived processes that analyze the same recording with
+    several settings, one :data:`sima_dir` each (see ``run_single.py
+    --pack``). If *ui* has corrected, or loaded, the same input file with
+    the same strategy and maximum displacement, :meth:`.motionCorrect`
+    builds this dataset from *ui*'s sequences in memory. The input isn't
+    hashed or read again, and plots reuse *ui*'s thumbnail instead of
+    computing the time averages again. Otherwise, motion correction runs
+    as usual.
+    
+    Args:
+      ui (SaraUI): The SaraUI that analyzed the same recording, usually in
+        the previous task.
+    
+    """
+    # keep to the SaraUI that loaded the correction, so that a long run of
+    # tasks doesn't keep every earlier SaraUI alive
+    if ui._correction_reused:
+      ui = ui._correction_source
+    self._correction_source = ui
+  
   def visualize(self, save_to=None, use_settings=False, warn=False):
     """Use matplotlib to show what ROIs were chosen by :meth:`.segment`.
     
@@ -971,10 +2734,26 @@ class SaraUI(CommandLineInterface):
         "horizontal_flip" : self._hflip,
         "vertical_flip"   : self._vflip,
       }
-    plt.rc('axes', color_cycle=vis_settings['color_cycle'])
-    plt.rc('lines', linewidth=vis_settings['linewidth'])
-    
-    self._plotROIs(save_to, warn)
+    # skip plotting if a previous run already saved this plot
+    record = use_settings and save_to != None
+    if record and self._stageComplete('visualize', self._stageInputs(
+                    'segment'), vis_settings, [save_to]):
+      print "Visualization already complete, skipping"
+      return
+    self._color_cycle = vis_settings['color_cycle']
+    self._linewidth = float(vis_settings['linewidth'])
+    self._rotation = vis_settings['rotation']
+    self._hflip = vis_settings['horizontal_flip']
+    self._vflip = vis_settings['vertical_flip']
+    
+    with self._measure('visualize'):
+      if save_to == None:
+        self._plotROIs(warn)
+      else:
+        self._renderROIs(save_to, warn)
+    if record:
+      self._recordStage('visualize', self._stageInputs('segment'),
+                        vis_settings, [save_to])
     
     if not use_settings:
       vis_settings['rotation']        = self._rotation
@@ -0,0 +1,283 @@
+#!/opt/python/bin/python2.7
+# Plans a batch analysis as a graph of tasks (motion correction once per
+# recording, then segmentation and export per recording and settings) and
+# runs it locally or submits it to SGE
+import argparse
+import csv
+import subprocess
+from os import makedirs
+from os.path import abspath, basename, isdir, isfile, join
+from pipes import quote
+from sys import stdout
+from time import sleep, time
+from traceback import print_exc
+from pandas import Series
+from image_index import image_path, update_index
+from settings_space import batch_settings
+
+# Settings shared by every task (and all motion-correction settings)
+SETTINGS_FILE = 'settings.csv'
+# Directory of settings files, one per combination
+SETTINGS_DIR = 'settings'
+# Sweep definition, used instead of SETTINGS_DIR if it exists
+SWEEP_FILE = 'sweep.csv'
+# qsub options, one per line
+TASK_SETTINGS = 'task_settings.txt'
+# Runs one line of a commands file as an SGE array task
+ARRAY_SCRIPT = 'sge_task.sh'
+
+def makedir(d):
+  if not isdir(d):
+    makedirs(d)
+
+class Task(object):
+  """One command in a batch analysis, and the tasks it has to wait for.
+
+  Args:
+    name (str): Unique name of the task.
+    array (str): Job array the task belongs to with the SGE backend; tasks
+      are numbered within an array in the order they are planned.
+    command (list): Program and arguments to run.
+    dependencies (list, optional): Names of tasks that must succeed first.
+
+  """
+
+  def __init__(self, name, array, command, dependencies=[]):
+    self.name = name
+    self.array = array
+    self.command = command
+    self.dependencies = list(dependencies)
+
+def plan(out_dir, num_images):
+  """Returns the tasks needed to analyze every recording with every setting
+
+  Each recording is motion-corrected once, by a ``correct`` task that
+  stores the correction in the ``mc_cache_dir`` of :data:`SETTINGS_FILE`.
+  An ``analyze`` task per recording and setting then runs ``run_single.py``
+  (which finds the correction in the cache) once its recording's
+  correction is done. Settings are chosen by
+  :func:`settings_space.batch_settings`, and output goes where
+  ``sge_run.sh`` puts it.
+
+  Correct tasks form one job array, and the analyze tasks of each setting
+  another, all numbered by recording, so that the *n*\ th analyze task of
+  every array depends only on the *n*\ th correct task.
+
+  Args:
+    out_dir (str): Where output will go; made absolute, since SGE tasks
+      run from ``sge_task.sh``'s directory.
+    num_images (int): Number of recordings in the image index.
+  Returns:
+    list: :class:`Task` objects, each after the tasks it depends on.
+
+  """
+  out_dir = abspath(out_dir)
+  settings = Series.from_csv(SETTINGS_FILE)
+  if settings.get('mc_cache_dir') is None:
+    raise ValueError("%s needs an mc_cache_dir entry for analysis tasks to"
+                     " share motion correction" % SETTINGS_FILE)
+  combinations = batch_settings(SWEEP_FILE, SETTINGS_DIR, SETTINGS_FILE)
+
+  tasks = []
+  for job_id in xrange(1, num_images + 1):
+    tasks.append(Task('correct%d' % job_id, 'correct',
+                      ['./scheduler.py', 'correct', str(job_id),
+                       SETTINGS_FILE, out_dir]))
+  for i, (name, settings_args) in enumerate(combinations):
+    for job_id in xrange(1, num_images + 1):
+      if name != None:
+        task_out = join(out_dir, name)
+      elif num_images > 1:
+        task_out = join(out_dir, basename(image_path(job_id)).split('.')[0])
+      else:
+        task_out = out_dir
+      command = ['./run_single.py', str(job_id), settings_args[0],
+                 task_out] + settings_args[1:]
+      tasks.append(Task('analyze%d_%s' % (job_id, name), 'analyze%d' % i,
+                        command, ['correct%d' % job_id]))
+  return tasks
+
+def correct(job_id, settings_file, out_dir):
+  """Motion-corrects the *job_id*-th recording into the correction cache
+
+  The dataset and corrected frames are made in ``<out_dir>/mc/``, and
+  copied into the cache as hard links where possible, so the frames there
+  are the cache's copy rather than extra output. Analysis tasks don't
+  read ``<out_dir>/mc/``.
+
+  """
+  # importing SARA is slow, so only do it if there's analysis to run
+  from sara import SaraUI
+  path = image_path(job_id)
+  recording = basename(path)
+  no_ex = recording[:recording.find('.tif')]
+  mc_dir = join(out_dir, 'mc')
+  makedir(mc_dir)
+  print "Correcting", recording
+  ui = SaraUI(join(mc_dir, no_ex + '.sima'), settings_file)
+  ui.motionCorrect(path, join(mc_dir, recording), use_settings=True)
+
+def run_local(tasks, processes, logs_dir):
+  """Runs tasks as subprocesses, at most *processes* at a time
+
+  A task starts as soon as all of its dependencies have succeeded; tasks
+  that depend on a failed task are skipped. Each task's output goes to
+  ``<logs_dir>/<name>.log``.
+
+  Returns:
+    list: Names of the tasks that failed or were skipped.
+
+  """
+  makedir(logs_dir)
+  pending = list(tasks)
+  running = []
+  done, failed = set(), set()
+  start = time()
+  while pending or running:
+    for task in list(pending):
+      if any(d in failed for d in task.dependencies):
+        print "Skipping %s (a dependency failed)" % task.name
+        failed.add(task.name)
+        pending.remove(task)
+      elif len(running) < processes \
+      and all(d in done for d in task.dependencies):
+        log = open(join(logs_dir, task.name + '.log'), 'w')
+        process = subprocess.Popen(task.command, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        running.append((task, process, log))
+        pending.remove(task)
+    sleep(0.2)
+    for task, process, log in list(running):
+      if process.poll() is None:
+        continue
+      log.close()
+      running.remove((task, process, log))
+      if process.returncode == 0:
+        done.add(task.name)
+      else:
+        failed.add(task.name)
+      print "[%d/%d] %s %s (%.0f s elapsed)" % (
+              len(done) + len(failed), len(tasks), task.name,
+              "done" if process.returncode == 0 else "FAILED",
+              time() - start)
+      stdout.flush()
+  return sorted(failed)
+
+def submit_sge(tasks, out_dir, qsub='qsub'):
+  """Submits *tasks* as SGE job arrays
+
+  The commands of each array (see :class:`Task`) are written, one per
+  line, to ``<out_dir>/<array>.commands``; array task *n* runs line *n*
+  with :data:`ARRAY_SCRIPT`. If the *n*\ th task of an array only depends
+  on the *n*\ th tasks of other arrays, the array is held task by task
+  (``-hold_jid_ad``), otherwise until the other arrays have finished
+  (``-hold_jid``). A task that exits with status 100 (as failed ``correct``
+  tasks do) is put in an error state by SGE, which keeps the tasks waiting
+  for it from running. Options in :data:`TASK_SETTINGS` are passed to
+  every submission.
+
+  Args:
+    tasks (list): :class:`Task` objects, as returned by :func:`plan`.
+    out_dir (str): Where to write the commands files.
+    qsub (str, optional): Command used to submit jobs, e.g. a local
+      stand-in like ``scripts/local_qsub.py`` for testing.
+  Returns:
+    list: Names of the submitted job arrays, in submission order.
+
+  """
+  options = []
+  if isfile(TASK_SETTINGS):
+    with open(TASK_SETTINGS) as fh:
+      options = ' '.join(line[0] for line in csv.reader(fh)).split()
+  # job names are set per array below
+  if '-N' in options:
+    i = options.index('-N')
+    del options[i:i + 2]
+
+  # the array of each task, and its number in the array (from 0)
+  arrays = []
+  counts = {}
+  position = {}
+  for task in tasks:
+    if task.array not in counts:
+      arrays.append(task.array)
+      counts[task.array] = 0
+    position[task.name] = (task.array, counts[task.array])
+    counts[task.array] += 1
+  submitted = []
+  for array in arrays:
+    array_tasks = [task for task in tasks if task.array == array]
+    commands_file = abspath(join(out_dir, array + '.commands'))
+    with open(commands_file, 'w') as fh:
+      for task in array_tasks:
+        fh.write(' '.join(quote(arg) for arg in task.command) + '\n')
+    job_name = 'sara_' + array
+    holds = sorted(set('sara_' + position[d][0] for task in array_tasks
+                       for d in task.dependencies))
+    # task by task if every dependency has the same number as its dependent
+    task_by_task = all(position[d][1] == n
+                       for n, task in enumerate(array_tasks)
+                       for d in task.dependencies)
+    command = qsub.split() + options + ['-N', job_name,
+                                        '-t', '1-%d' % len(array_tasks)]
+    if holds:
+      command += ['-hold_jid_ad' if task_by_task else '-hold_jid',
+                  ','.join(holds)]
+    command += [ARRAY_SCRIPT, commands_file]
+    print "running", ' '.join(command)
+    stdout.flush()
+    subprocess.check_call(command)
+    submitted.append(job_name)
+  return submitted
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Run a batch analysis as a graph of tasks: each recording "
+                "is motion-corrected once, then analyzed with every "
+                "setting.")
+  commands = parser.add_subparsers(dest='action')
+  run = commands.add_parser('run', help="plan and run (or submit) tasks")
+  run.add_argument('out_dir', help="where output will go")
+  run.add_argument('--backend', choices=['local', 'sge'], default='local')
+  run.add_argument('--processes', type=int, default=1,
+                   help="tasks to run at once with the local backend")
+  run.add_argument('--qsub', default='qsub',
+                   help="submission command for the sge backend")
+  run.add_argument('--dry-run', action='store_true',
+                   help="only print the planned tasks")
+  task = commands.add_parser('correct',
+                             help="motion-correct one recording (run by "
+                                  "'correct' tasks)")
+  task.add_argument('job_id', type=int)
+  task.add_argument('settings_file')
+  task.add_argument('out_dir')
+  args = parser.parse_args()
+
+  if args.action == 'correct':
+    try:
+      correct(args.job_id, args.settings_file, args.out_dir)
+    except Exception:
+      print_exc()
+      # SGE puts a task that exits with 100 in an error state, so the tasks
+      # held on it don't run (and correct the recording themselves)
+      exit(100)
+    exit()
+
+  makedir(args.out_dir)
+  tasks = plan(args.out_dir, len(update_index()))
+  if args.dry_run:
+    for task in tasks:
+      print "%-24s %-40s after %s" % (task.name, ' '.join(task.command),
+                                      ', '.join(task.dependencies) or '-')
+  elif args.backend == 'local':
+    failed = run_local(tasks, args.processes, join(args.out_dir, 'logs'))
+    if failed:
+      print "%d tasks failed or were skipped (see %s):" % (
+              len(failed), join(args.out_dir, 'logs'))
+      for name in failed:
+        print " ", name
+      exit(1)
+    else:
+      print "Analysis done"
+  else:
+    submit_sge(tasks, args.out_dir, args.qsub)
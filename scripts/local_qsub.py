@@ -0,0 +1,69 @@
+#!/opt/python/bin/python2.7
+# Stands in for qsub when testing job submission on a machine without SGE:
+# runs every task of a job array right away, one after another
+from os import environ
+from os.path import isfile
+from subprocess import call
+from sys import argv
+
+if len(argv) < 2:
+  exit("Usage: %s [qsub options] script [script arguments]" % argv[0])
+
+# options that take a value; everything else is a flag
+VALUE_OPTIONS = ['-N', '-t', '-hold_jid', '-hold_jid_ad', '-v', '-o', '-e',
+                 '-S', '-M', '-m', '-l', '-q', '-pe', '-wd']
+# Tasks that exited with status 100, which SGE leaves in an error state, as
+# "job_name task_id" lines; kept between submissions
+ERROR_FILE = '.local_qsub_errors'
+
+name = 'sara'
+first, last = 1, 1
+holds = []
+env = dict(environ)
+i = 1
+while i < len(argv) and argv[i].startswith('-'):
+  option = argv[i]
+  value = argv[i + 1] if option in VALUE_OPTIONS else None
+  if option == '-N':
+    name = value
+  elif option == '-t':
+    first, _, last = value.partition('-')
+    first, last = int(first), int(last or first)
+  elif option == '-v':
+    for variable in value.split(','):
+      key, _, val = variable.partition('=')
+      env[key] = val
+  elif option == '-hold_jid_ad':
+    holds = value.split(',')
+  # -hold_jid needs no handling: earlier submissions have already finished
+  i += 2 if option in VALUE_OPTIONS else 1
+script = argv[i:]
+
+errors = []
+if isfile(ERROR_FILE):
+  with open(ERROR_FILE) as fh:
+    errors = [tuple(line.split()) for line in fh]
+# a new submission under the same name replaces the old one
+errors = [e for e in errors if e[0] != name]
+
+print 'Your job-array local.%d-%d:1 ("%s") has been submitted' % (
+        first, last, name)
+failures = 0
+for task_id in xrange(first, last + 1):
+  # like SGE, never release a task held on one in an error state
+  if any((hold, str(task_id)) in errors for hold in holds):
+    print "Task %d of %s is held on a task in an error state" % (task_id,
+                                                                 name)
+    failures += 1
+    continue
+  env['SGE_TASK_ID'] = str(task_id)
+  status = call(['bash'] + script, env=env)
+  if status == 100:
+    errors.append((name, str(task_id)))
+  if status != 0:
+    failures += 1
+with open(ERROR_FILE, 'w') as fh:
+  for error in errors:
+    fh.write(' '.join(error) + '\n')
+if failures:
+  print "%d of %d tasks of %s failed" % (failures, last - first + 1, name)
@@ -0,0 +1,47 @@
+#!/opt/python/bin/python2.7
+# Ranks the settings of a sweep by the segmentation scores (sara_scores.csv,
+# written by SaraUI.score) of every recording they were run on
+from os import walk
+from os.path import isdir, join
+from sys import argv
+from pandas import concat, read_csv
+
+if not len(argv) in [2, 3, 4]:
+  exit("Usage: %s out_dir|scores.csv [ranking.csv] [sort_column]" % argv[0])
+
+# Collect scores from every run, or from one shared scores_file
+if isdir(argv[1]):
+  runs = []
+  for dirpath, dirnames, filenames in walk(argv[1]):
+    if 'sara_scores.csv' in filenames:
+      runs.append(read_csv(join(dirpath, 'sara_scores.csv')))
+  if not runs:
+    exit("No sara_scores.csv files found in %s" % argv[1])
+  scores = concat(runs, ignore_index=True)
+else:
+  scores = read_csv(argv[1])
+# a re-run replaces earlier scores of the same settings and recording
+scores = scores.drop_duplicates(['settings', 'recording'], keep='last')
+print len(scores), "runs found"
+
+# Typical scores of each settings across recordings
+by_settings = scores.groupby('settings')
+ranking = by_settings.median()
+ranking.insert(0, 'recordings', by_settings.size())
+# how consistently each settings segments different recordings
+ranking['rois_cv'] = by_settings['rois'].std() / by_settings['rois'].mean()
+sort_column = argv[3] if len(argv) == 4 else 'snr_median'
+ranking = ranking.sort_values(sort_column, ascending=False)
+
+print ""
+print "Median scores by settings, best first (by %s):" % sort_column
+columns = ['recordings', 'rois', 'rois_cv', 'area_median',
+           'compactness_median', 'looped_rois', 'snr_median',
+           'correlation_mean']
+print ranking[columns].head(20).to_string(
+        float_format=lambda x: '%.3f' % x)
+
+if len(argv) >= 3:
+  ranking.to_csv(argv[2])
+  print ""
+  print "Ranking written to", argv[2]
@@ -0,0 +1,62 @@
+#!/opt/python/bin/python2.7
+# Summarizes the per-stage metrics (sara_metrics.csv) of every analysis
+# directory in a sweep's output directory
+from os import walk
+from os.path import join, relpath
+from sys import argv
+from pandas import concat, read_csv
+
+if not len(argv) in [2, 3]:
+  exit("Usage: %s out_dir [summary.csv]" % argv[0])
+
+out_dir = argv[1]
+
+# Collect metrics from every run
+runs = []
+for dirpath, dirnames, filenames in walk(out_dir):
+  if 'sara_metrics.csv' in filenames:
+    metrics = read_csv(join(dirpath, 'sara_metrics.csv'))
+    metrics['run'] = relpath(dirpath, out_dir)
+    runs.append(metrics)
+if not runs:
+  exit("No sara_metrics.csv files found in %s" % out_dir)
+metrics = concat(runs, ignore_index=True)
+print len(runs), "runs found"
+
+# Throughput relative to the amount of data processed
+metrics['megapixels'] = metrics['frames'] * metrics['height'] * \
+                          metrics['width'] / 1e6
+metrics['seconds_per_megapixel'] = metrics['wall_time'] / metrics['megapixels']
+
+# Per-stage totals and typical costs
+by_stage = metrics.groupby('stage')
+summary = by_stage['wall_time'].agg(['count', 'sum', 'median', 'max'])
+summary['cpu_time'] = by_stage['cpu_time'].sum()
+summary['peak_rss_mb'] = by_stage['peak_rss_mb'].max()
+summary['seconds_per_megapixel'] = by_stage['seconds_per_megapixel'].median()
+summary = summary.sort_values('sum', ascending=False)
+print ""
+print "Wall time (s) by stage:"
+print summary.to_string(float_format=lambda x: '%.2f' % x)
+
+# How segmentation scales with the number of PCA components
+segment = metrics[metrics['stage'] == 'segment']
+if len(segment):
+  print ""
+  print "Segmentation wall time (s) by number of components:"
+  by_components = segment.groupby('components')
+  scaling = by_components['wall_time'].agg(['count', 'median', 'max'])
+  scaling['peak_rss_mb'] = by_components['peak_rss_mb'].max()
+  print scaling.to_string(float_format=lambda x: '%.2f' % x)
+
+# Slowest individual runs
+print ""
+print "Slowest stages:"
+slowest = metrics.sort_values('wall_time', ascending=False).head(10)
+print slowest[['run', 'stage', 'wall_time', 'frames', 'height', 'width',
+               'rois', 'components']].to_string(index=False)
+
+if len(argv) == 3:
+  summary.to_csv(argv[2])
+  print ""
+  print "Summary written to", argv[2]
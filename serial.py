@@ -1,10 +1,18 @@
 #!/usr/bin/env python
-# Execute SARA analysis in series (as opposed to parallel) on one machine
-from os import mkdir, walk
-from os.path import abspath, join, isdir
+# Execute SARA analysis on one machine, running several recordings at once
+# in a pool of worker processes
+import sys
+from multiprocessing import Pool, cpu_count
+from os import devnull, mkdir, sysconf, walk
+from os.path import abspath, getsize, isfile, join, isdir
 from shutil import rmtree
+from time import time
+from traceback import format_exc
 from sara import SaraUI
 
+# Approximate peak memory used by one job, as a multiple of the TIFF's size
+MEMORY_PER_BYTE = 4
+
 def run_sara(dirpath, recording, settings_file, analysis_dir, mc_dir,
                plots_dir, signals_outdir):
   """Use settings from previous run to analyze a new directory"""
@@ -16,7 +24,14 @@ def run_sara(dirpath, recording, settings_file, analysis_dir, mc_dir,
   mc_outfile = join(mc_dir, recording)
   plot_out = join(plots_dir, recording)
   signal_out = join(signals_outdir, no_ex + '.csv')
-  
+
+  # SIMA asks before overwriting a dataset, which workers can't answer;
+  # start over if an earlier run didn't finish motion correction
+  manifest = join(sima_dir, 'sara_motionCorrect.json')
+  if isdir(sima_dir) and not isfile(manifest):
+    print "Cleaning", abspath(sima_dir)
+    rmtree(sima_dir)
+
   # run analysis
   print "Analyzing", recording
   ui = SaraUI(sima_dir, settings_file)
@@ -24,33 +39,106 @@ def run_sara(dirpath, recording, settings_file, analysis_dir, mc_dir,
   ui.segment(use_settings=True)
   ui.visualize(plot_out, use_settings=True)
   ui.exportSignal(signal_out, use_settings=True)
+  ui.score()
+
+def run_job(args):
+  """Runs :func:`run_sara` in a worker, logging output to its own file
+
+  Returns a tuple of (recording, succeeded, seconds elapsed).
+
+  """
+  recording, log_file = args[1], args[-1]
+  start = time()
+  log = open(log_file, 'w')
+  streams = sys.stdin, sys.stdout, sys.stderr
+  # prompts fail at once instead of waiting for input that can't come
+  sys.stdin = open(devnull)
+  sys.stdout = sys.stderr = log
+  try:
+    run_sara(*args[:-1])
+    succeeded = True
+  except EOFError:
+    print format_exc()
+    sima_dir = join(args[3], recording[:recording.find('.tif')] + '.sima')
+    print "SIMA asked whether to overwrite %s, which can't be answered in" \
+            % sima_dir
+    print "a worker; remove it and run again"
+    succeeded = False
+  except Exception:
+    print format_exc()
+    succeeded = False
+  finally:
+    sys.stdin.close()
+    sys.stdin, sys.stdout, sys.stderr = streams
+    log.close()
+  return recording, succeeded, time() - start
+
+def pool_size(recordings):
+  """Number of workers that fit in both the CPU count and physical RAM"""
+  ram = sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE')
+  largest = max(getsize(join(d, r)) for d, r in recordings)
+  by_memory = int(ram / (MEMORY_PER_BYTE * largest))
+  return max(1, min(cpu_count(), by_memory, len(recordings)))
+
+if __name__ == '__main__':
+  # Set up output directories for motion-corrected images, plots showing
+  # segmentation results, signals and per-recording logs. Existing output is
+  # kept; recordings are re-analyzed into the same locations.
+  mc_dir = "corrected"
+  plots_dir = "plots"
+  signals_dir = "signals"
+  analysis_dir = "analysis"
+  logs_dir = "logs"
+  for d in [mc_dir, plots_dir, signals_dir, analysis_dir, logs_dir]:
+    if not isdir(d):
+      mkdir(d)
+
+  # File containing the settings we want use on all directories
+  settings_file = "settings.csv"
+
+  # Find all of the .tif files
+  data_dir = '/Users/nathan/work/sean/data'
+  visited_dirs = []
+  recordings = []
+  for dirpath, dirnames, filenames in walk(data_dir):
+    for filename in filenames:
+      # Run SARA, but only use original Control recordings
+      if not dirpath in visited_dirs \
+      and 'Control' in dirpath \
+      and filename.endswith('.tif'):
+        visited_dirs.append(dirpath)
+        recordings.append((dirpath, filename))
+
+  jobs = []
+  for dirpath, filename in recordings:
+    log_file = join(logs_dir, filename[:filename.find('.tif')] + '.log')
+    jobs.append((dirpath, filename, settings_file, analysis_dir, mc_dir,
+                 plots_dir, signals_dir, log_file))
+
+  # Run the jobs; each worker handles a single recording so that memory held
+  # by SIMA and matplotlib is released between recordings
+  failed = []
+  if jobs:
+    processes = pool_size(recordings)
+    print "Analyzing %d recordings with %d processes" % (len(jobs), processes)
+    pool = Pool(processes, maxtasksperchild=1)
+    start = time()
+    for done, result in enumerate(pool.imap_unordered(run_job, jobs), 1):
+      recording, succeeded, elapsed = result
+      if not succeeded:
+        failed.append(recording)
+      rate = done / (time() - start) * 3600
+      print "[%d/%d] %s %s in %.0f s (%.1f recordings/hour)" % (
+              done, len(jobs), recording, "done" if succeeded else "FAILED",
+              elapsed, rate)
+      sys.stdout.flush()
+    pool.close()
+    pool.join()
+    print "Finished %d recordings in %.0f s" % (len(jobs), time() - start)
 
-# Set up output directories for motion-corrected images, plots showing
-# segmentation results, and signals
-# MAKE SURE THESE NAMES ARE CORRECT OR ELSE ALL YOUR DATA WILL BE DELETED
-mc_dir = "corrected"
-plots_dir = "plots"
-signals_dir = "signals"
-analysis_dir = "analysis"
-for d in [mc_dir, plots_dir, signals_dir, analysis_dir]:
-  if isdir(d):
-    print "Cleaning", abspath(d)
-    rmtree(d)
-  mkdir(d)
-
-# File containing the settings we want use on all directories
-settings_file = "settings.csv"
-
-# Find all of the .tif files
-data_dir = '/Users/nathan/work/sean/data'
-visited_dirs = []
-for dirpath, dirnames, filenames in walk(data_dir):
-  for filename in filenames:
-    # Run SARA, but only use original Control recordings
-    if not dirpath in visited_dirs \
-    and 'Control' in dirpath \
-    and filename.endswith('.tif'):
-      visited_dirs.append(dirpath)
-      run_sara(dirpath, filename, settings_file, analysis_dir, mc_dir,
-                 plots_dir, signals_dir)
-print "Analysis done"
+  if failed:
+    print "%d recordings failed (see %s):" % (len(failed), logs_dir)
+    for recording in sorted(failed):
+      print " ", recording
+  else:
+    print "Analysis done"
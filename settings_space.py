@@ -0,0 +1,255 @@
+#!/opt/python/bin/python2.7
+# Describes a parameter sweep once and generates its settings lazily, by
+# index, so that sweeps don't need one settings file per combination
+from os import listdir
+from os.path import isdir, isfile, join
+from sys import argv
+from numpy import arange, array, linspace, log10, logspace, prod, \
+                  unravel_index
+from numpy.random import RandomState
+from pandas import Series
+
+# Short names of settings, used to name combinations on a grid
+ABBREVIATIONS = {
+  'mu'          : 'mu',
+  'overlap_per' : 'op',
+  'components'  : 'c',
+}
+# Settings that must be whole numbers
+INTEGER_SETTINGS = ['components']
+# Suffixes of the entries that describe one parameter
+SUFFIXES = ['start', 'stop', 'step', 'num', 'scale', 'values']
+# Entries that describe the sweep as a whole
+SWEEP_OPTIONS = ['sampling', 'samples', 'seed']
+
+def build_filename(names, values):
+  """Builds a settings name from abbreviations of each setting's value
+
+  Fractional settings are given as percentages, so ``mu = 0.5`` and
+  ``components = 30`` become ``mu50c30``.
+
+  """
+  filename = ''
+  for name, value in zip(names, values):
+    abbr = ABBREVIATIONS.get(name, name)
+    if name not in INTEGER_SETTINGS:
+      value *= 100
+    filename += '%s%.0f' % (abbr, value)
+  return filename
+
+def batch_settings(sweep_file='sweep.csv', settings_dir='settings',
+                   settings_file='settings.csv'):
+  """Returns the settings of every combination in a batch analysis
+
+  Settings are chosen as ``sge_submit.sh`` chooses them: from
+  *sweep_file* if it exists, otherwise from the files in *settings_dir*,
+  otherwise from *settings_file* alone.
+
+  Returns:
+    list: A ``(name, arguments)`` pair per combination, where *arguments*
+    are the ``settings_file [setting_index]`` arguments of
+    ``run_single.py``, and *name* is the combination's output directory,
+    or ``None`` if *settings_file* is used alone.
+
+  """
+  if isfile(sweep_file):
+    space = SettingsSpace(sweep_file)
+    return [(space.name(i), [sweep_file, str(i)]) for i in xrange(len(space))]
+  if isdir(settings_dir) and listdir(settings_dir):
+    return [(name, [join(settings_dir, name)])
+            for name in sorted(listdir(settings_dir))]
+  return [(None, [settings_file])]
+
+class SettingsSpace(object):
+  """A sweep over analysis settings, generated lazily by index.
+
+  The sweep is described by a settings-style CSV file (like
+  ``param_settings.csv``) with a few entries per parameter:
+
+  * ``<name>_start``, ``<name>_stop`` and ``<name>_step``: values from
+    :func:`numpy.arange`, as used by ``autogen_settings.py``;
+  * ``<name>_start``, ``<name>_stop`` and ``<name>_num``: *num* evenly
+    spaced values, including *stop*; add ``<name>_scale,log`` to space
+    them logarithmically;
+  * ``<name>_values``: an explicit, quoted, comma-separated list.
+
+  By default every combination of values is included (``sampling,grid``).
+  With ``sampling,random`` or ``sampling,lhs``, *samples* combinations are
+  drawn at random, or by Latin hypercube sampling, from the parameters'
+  ranges (``<name>_start`` to ``<name>_stop``, log-uniformly if
+  ``<name>_scale`` is ``log``) or lists of values. Samples depend only on
+  *seed* and their index.
+
+  Nothing is materialized: the *n*\ th combination is computed when it is
+  asked for, so a job only needs the definition file and its index.
+
+  Example:
+    Settings for the 12th combination of a sweep::
+
+      space = SettingsSpace('sweep.csv')
+      settings = space.settings(12, Series.from_csv('settings.csv'))
+
+  Args:
+    definition (str or pandas.Series): The sweep definition, or the path
+      to its CSV file.
+
+  """
+
+  def __init__(self, definition):
+    if isinstance(definition, basestring):
+      definition = Series.from_csv(definition)
+    self.sampling = str(definition.get('sampling', 'grid'))
+    if self.sampling not in ['grid', 'random', 'lhs']:
+      raise ValueError("Unknown sampling: %s" % self.sampling)
+    self.seed = int(definition.get('seed', 0))
+
+    # parameters, in the order they first appear in the definition
+    self.names = []
+    for key in definition.index:
+      if key in SWEEP_OPTIONS:
+        continue
+      name, _, suffix = key.rpartition('_')
+      if suffix not in SUFFIXES or not name:
+        raise ValueError("Unknown sweep entry: %s" % key)
+      if name not in self.names:
+        self.names.append(name)
+    self._params = [self._parseParam(name, definition)
+                    for name in self.names]
+
+    if self.sampling == 'grid':
+      for name, param in zip(self.names, self._params):
+        if param['values'] is None:
+          raise ValueError("%s needs a step, num or values to be swept on"
+                           " a grid" % name)
+      self.shape = tuple(len(p['values']) for p in self._params)
+      self._size = int(prod(self.shape, dtype=object))
+    else:
+      self._size = int(definition['samples'])
+    self._permutations = {}
+
+  def __len__(self):
+    return self._size
+
+  def __getitem__(self, index):
+    """Returns the values of each parameter for one combination as a dict"""
+    if index < 0 or index >= self._size:
+      raise IndexError("Setting %d is out of range of %d settings" % (
+                         index, self._size))
+    if self.sampling == 'grid':
+      positions = unravel_index(index, self.shape)
+      values = [p['values'][i] for p, i in zip(self._params, positions)]
+    else:
+      # one generator per sample, so any sample can be drawn on its own
+      rs = RandomState([self.seed, index])
+      if self.sampling == 'random':
+        quantiles = rs.uniform(size=len(self._params))
+      else:
+        strata = array([self._permutation(d)[index]
+                        for d in xrange(len(self._params))])
+        quantiles = (strata + rs.uniform(size=len(self._params))) / \
+                      self._size
+      values = [self._quantile(p, q) for p, q in zip(self._params, quantiles)]
+    combination = {}
+    for name, value in zip(self.names, values):
+      if name in INTEGER_SETTINGS:
+        value = int(round(value))
+      else:
+        value = float(value)
+      combination[name] = value
+    return combination
+
+  def _parseParam(self, name, definition):
+    """Returns the values or range of one parameter of the sweep"""
+    entry = lambda suffix: definition.get(name + '_' + suffix)
+    param = {
+      'values' : None,
+      'start'  : entry('start'),
+      'stop'   : entry('stop'),
+      'log'    : entry('scale') == 'log',
+    }
+    if entry('values') is not None:
+      param['values'] = array([float(v) for v in
+                               str(entry('values')).split(',')])
+      param['start'] = param['stop'] = None
+      return param
+    if param['start'] is None or param['stop'] is None:
+      raise ValueError("%s needs a start and stop, or values" % name)
+    param['start'] = float(param['start'])
+    param['stop'] = float(param['stop'])
+    if param['log']:
+      param['start'], param['stop'] = log10(param['start']), \
+                                      log10(param['stop'])
+    if entry('step') is not None:
+      # on a log scale, steps are in decades
+      param['values'] = arange(param['start'], param['stop'],
+                               float(entry('step')))
+      if param['log']:
+        param['values'] = 10 ** param['values']
+    elif entry('num') is not None:
+      space = logspace if param['log'] else linspace
+      param['values'] = space(param['start'], param['stop'],
+                              int(entry('num')))
+    return param
+
+  def _permutation(self, dimension):
+    """Returns the order of Latin hypercube strata along one parameter"""
+    if dimension not in self._permutations:
+      rs = RandomState([self.seed, self._size, dimension])
+      self._permutations[dimension] = rs.permutation(self._size)
+    return self._permutations[dimension]
+
+  def _quantile(self, param, q):
+    """Returns the value at quantile *q* of a parameter's values or range"""
+    if param['start'] is None:
+      return param['values'][min(int(q * len(param['values'])),
+                                 len(param['values']) - 1)]
+    value = param['start'] + q * (param['stop'] - param['start'])
+    if param['log']:
+      value = 10 ** value
+    return value
+
+  def name(self, index):
+    """Returns the name of one combination, for use as an output directory
+
+    Grid combinations are named after their values (see
+    :func:`build_filename`), as ``autogen_settings.py`` names settings
+    files. Samples are numbered, with enough leading zeros that names sort
+    in index order.
+
+    """
+    if self.sampling == 'grid':
+      combination = self[index]
+      return build_filename(self.names,
+                            [combination[n] for n in self.names])
+    return 'sample%0*d' % (len(str(self._size - 1)), index)
+
+  def settings(self, index, base):
+    """Returns the complete settings for one combination.
+
+    Args:
+      index (int): The combination, counting from 0.
+      base (pandas.Series): Settings shared by every combination, e.g.
+        from ``settings.csv``; not modified.
+    Returns:
+      pandas.Series: *base* with the combination's values, and a
+      ``settings_name`` entry holding :meth:`.name`.
+
+    """
+    settings = base.copy()
+    for name, value in self[index].iteritems():
+      settings[name] = value
+    settings['settings_name'] = self.name(index)
+    return settings
+
+if __name__ == '__main__':
+  if not len(argv) in [2, 3]:
+    print "Usage: %s sweep_file [index]" % argv[0]
+    print "  Prints the number of settings in the sweep described by"
+    print "  sweep_file, or the name of the index-th setting (counting"
+    print "  from 0)"
+    exit()
+  space = SettingsSpace(argv[1])
+  if len(argv) == 2:
+    print len(space), "settings"
+  else:
+    print space.name(int(argv[2]))
@@ -12,6 +12,8 @@ TASKOUT=$HOME/out/sara.o$SGE_TASK_ID
 TASKERR=$HOME/out/sara.e$SGE_TASK_ID
 
 SETTINGS_SINGLE=settings.csv
+# Sweep definition used when numset is "sweep" (see settings_space.py)
+SWEEP=sweep.csv
 
 cd $SARADIR
 
@@ -19,6 +21,26 @@ if [ ! -z $1 ]; then
   SGE_TASK_ID=1 # for debugging only
 fi
 
+# With packing, each array element runs $pack consecutive tasks in one
+# process (see run_single.py --pack), which numbers tasks image by image
+if [ ${pack:-1} -gt 1 ]; then
+  njobs=$((($ntasks + $pack - 1) / $pack))
+  while [ $SGE_TASK_ID -le $njobs ]; do
+    first=$((($SGE_TASK_ID - 1) * $pack + 1))
+    last=$(($SGE_TASK_ID * $pack))
+    CMD="./run_single.py --pack $first $last $SARADIR/out"
+    echo "(SGE_TASK_ID $SGE_TASK_ID): $CMD"
+    if [ -z $1 ]; then
+      $CMD > $TASKOUT 2> $TASKERR
+      exit 0
+    else
+      # Debugging mode
+      ((SGE_TASK_ID++))
+    fi
+  done
+  exit 0
+fi
+
 # Make sure this line is set according to your job array settings
 while [ $SGE_TASK_ID -le $ntasks ]; do
   settings=()
@@ -31,7 +53,12 @@ while [ $SGE_TASK_ID -le $ntasks ]; do
   setting_i=$(($taskm1 / $ni))
   task_i=$(($taskm1 % $ni + 1))
   
-  settings_name=`basename ${settings[$setting_i]}`
+  if [ $numset == "sweep" ]; then
+    # settings are generated from the sweep definition by index
+    settings_name=$(./settings_space.py $SWEEP $setting_i | tail -n1)
+  else
+    settings_name=`basename ${settings[$setting_i]}`
+  fi
   if [ $numset == "single" ]; then
     if [ $ni -eq 1 ]; then
       outdir=$SARADIR/out
@@ -41,17 +68,23 @@ while [ $SGE_TASK_ID -le $ntasks ]; do
       outdir=$SARADIR/out/${image_name}
     fi
     settings_file=$SARADIR/$SETTINGS_SINGLE
+  elif [ $numset == "sweep" ]; then
+    settings_file=$SARADIR/$SWEEP
+    outdir=$SARADIR/out/${settings_name}
   else
     settings_file=$SARADIR/settings/${settings_name}
     outdir=$SARADIR/out/${settings_name}
   fi
   
   CMD="./run_single.py $task_i ${settings_file} $outdir"
+  if [ $numset == "sweep" ]; then
+    CMD="$CMD $setting_i"
+  fi
   echo "(SGE_TASK_ID $SGE_TASK_ID): $CMD"
   
   if [ -z $1 ]; then
     cd $SARADIR/out
-    if [ $numset == "multi" ]; then
+    if [ $numset != "single" ]; then
       # create a directory with the same name as the settings file
       if [ ! -d ${settings_name} ]; then
         mkdir ${settings_name}
@@ -1,5 +1,8 @@
 #!/bin/bash
 # Handles submission of sge_run.sh
+#
+# Run as ./sge_submit.sh [tasks_per_job] to have each array element run
+# several short tasks in one process (see run_single.py --pack)
 
 # Directory containing sara.py etc.
 SARADIR=$HOME/sara
@@ -11,6 +14,12 @@ QSOPTS=`$SARADIR/scripts/parse_settings.py $TASK_SETTINGS`
 SCRIPT=sge_run.sh
 # Settings file for running one set of settings
 SINGLE_SETTINGS=settings.csv
+# Sweep definition; if it exists, settings are generated from it by each
+# task instead of being read from settings/
+SWEEP=sweep.csv
+
+# Tasks run by each array element
+PACK=${1:-1}
 
 # Also add custom variable for num of images found
 NI=$(./run_single.py -1 2> /dev/null | tail -n1 | awk '{print $1}')
@@ -31,8 +40,13 @@ elif [ "$(ls -A $SARADIR/out)" ]; then
   exit
 fi
 
-# Set numset (whether to use single or multi settings)
-if [ $numset -eq 0 ]; then
+# Set numset (whether to use single, multi or sweep settings)
+if [ -e $SWEEP ]; then
+  NSET=$(./settings_space.py $SWEEP | tail -n1 | awk '{print $1}')
+  echo "Using $NSET settings from $SWEEP"
+  numset=sweep
+  NTASKS=$(($NSET * $NI))
+elif [ $numset -eq 0 ]; then
   if [ ! -e $SINGLE_SETTINGS ]; then
     echo "Error: $SINGLE_SETTINGS does not exist!"
     exit
@@ -45,7 +59,11 @@ else
 fi
 
 # Build command
-QSOPTS="${QSOPTS} -t 1-$NTASKS -v ni=$NI,numset=$numset,ntasks=$NTASKS"
+NJOBS=$((($NTASKS + $PACK - 1) / $PACK))
+if [ $PACK -gt 1 ]; then
+  echo "Packing $NTASKS tasks into $NJOBS jobs"
+fi
+QSOPTS="${QSOPTS} -t 1-$NJOBS -v ni=$NI,numset=$numset,ntasks=$NTASKS,pack=$PACK"
 CMD="qsub $QSOPTS $SCRIPT"
 
 # Run command
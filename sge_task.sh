@@ -0,0 +1,17 @@
+#!/bin/bash
+# Runs one task of a job array submitted by scheduler.py: line $SGE_TASK_ID
+# of the commands file given as the first argument
+#
+# To see which command a task would run, run like this:
+#   SGE_TASK_ID=3 ./sge_task.sh out/analyze.commands test
+
+SARADIR=${SARADIR:-$HOME/sara}
+
+cd $SARADIR
+
+CMD=$(sed -n "${SGE_TASK_ID}p" $1)
+echo "(SGE_TASK_ID $SGE_TASK_ID): $CMD"
+
+if [ -z $2 ]; then
+  eval "$CMD"
+fi
@@ -0,0 +1,288 @@
+#!/opt/python/bin/python2.7
+# Consolidates the signals of a whole sweep into one indexed SQLite file
+import csv
+import sqlite3
+from contextlib import contextmanager
+from os import getpid, listdir, mkdir, rename, rmdir
+from os.path import getmtime, isdir, join, splitext
+from socket import gethostname
+from sys import argv
+from time import sleep, time
+from numpy import array, asarray, concatenate, float32, frombuffer, load, \
+                  loadtxt
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+  id INTEGER PRIMARY KEY,
+  settings TEXT NOT NULL,
+  recording TEXT NOT NULL,
+  num_frames INTEGER NOT NULL,
+  frames_per_second REAL,
+  UNIQUE (settings, recording)
+);
+CREATE INDEX IF NOT EXISTS recordings_by_recording
+  ON recordings (recording);
+CREATE TABLE IF NOT EXISTS signals (
+  recording_id INTEGER NOT NULL REFERENCES recordings (id),
+  roi_id INTEGER NOT NULL,
+  label TEXT,
+  data BLOB NOT NULL,
+  PRIMARY KEY (recording_id, roi_id)
+);
+"""
+
+def break_stale_lock(lock_dir, timeout):
+  """Removes the lock directory *lock_dir* if it is older than *timeout* s
+
+  Waiters take turns, through a second lock directory, to check and remove
+  a stale lock, and check its age again once it is their turn. So a lock
+  that another waiter has just broken, and a third process has just taken,
+  is never removed.
+
+  """
+  breaker = lock_dir + '.break'
+  try:
+    mkdir(breaker)
+  except OSError:
+    # another waiter is checking; if it died doing so, its directory goes
+    # stale too and is moved aside (under a unique name) before removal
+    try:
+      if time() - getmtime(breaker) > timeout:
+        aside = '%s.%s.%d' % (breaker, gethostname(), getpid())
+        rename(breaker, aside)
+        rmdir(aside)
+    except OSError:
+      pass # moved aside by someone else
+    return
+  try:
+    if time() - getmtime(lock_dir) > timeout:
+      rmdir(lock_dir)
+  except OSError:
+    pass # released while we were checking
+  finally:
+    rmdir(breaker)
+
+@contextmanager
+def directory_lock(lock_dir, timeout=600):
+  """Holds an exclusive lock for the duration of a ``with`` block
+
+  The lock is the directory *lock_dir*, which is safe to create atomically
+  over NFS. A lock older than *timeout* seconds is considered stale and
+  removed (see :func:`break_stale_lock`), so *timeout* must be longer
+  than the lock is ever held.
+
+  """
+  while True:
+    try:
+      mkdir(lock_dir)
+      break
+    except OSError:
+      break_stale_lock(lock_dir, timeout)
+      sleep(0.5)
+  try:
+    yield
+  finally:
+    rmdir(lock_dir)
+
+class SignalStore(object):
+  """Signals from many recordings and settings, indexed in one SQLite file.
+
+  Each ROI's signal is stored as a float32 array, indexed by settings
+  name, recording name and ROI id. Readers and writers take an exclusive
+  lock (a ``<path>.lock`` directory, which is safe to create atomically
+  over NFS, unlike SQLite's own locks), so many jobs can add their results
+  as they finish, and nobody reads a half-written recording.
+
+  Example:
+    Reading every signal for one recording::
+
+      store = SignalStore('signals.db')
+      roi_ids, signals = store.get('mu50op20c30', 'recording01')
+
+  Args:
+    path (str): SQLite file to use; created if it doesn't exist.
+    lock_timeout (float, optional): Seconds after which another writer's
+      lock is considered stale and removed.
+
+  """
+
+  def __init__(self, path, lock_timeout=600):
+    self.path = path
+    self.lock_timeout = lock_timeout
+    self._lock_dir = path + '.lock'
+    with self._lock():
+      connection = sqlite3.connect(path)
+      connection.executescript(SCHEMA)
+      connection.close()
+
+  def _lock(self):
+    """Holds the store's lock for the duration of a ``with`` block"""
+    return directory_lock(self._lock_dir, self.lock_timeout)
+
+  def add(self, settings, recording, roi_ids, signals, labels=None,
+          frames_per_second=None, block_rois=256):
+    """Adds (or replaces) the signals of one recording.
+
+    Signals are converted and inserted *block_rois* ROIs at a time, so
+    memory-mapped signals (as extracted by
+    :meth:`sara.SaraUI._extractBlocks`) are never loaded whole.
+
+    Args:
+      settings (str): Name of the settings file used for analysis.
+      recording (str): Name of the recording.
+      roi_ids (list): ROI id of each row of *signals*.
+      signals (numpy.ndarray or list): Array of shape ``(num_rois,
+        num_frames)``, or a list of such arrays (one per sequence, like
+        :data:`sara.SaraUI.signal`\ ``['raw']``) to be joined along frames.
+      labels (list, optional): ROI labels, in the same order as *roi_ids*.
+      frames_per_second (float, optional): Capture rate of the recording.
+      block_rois (int, optional): Number of ROIs to insert at a time.
+
+    """
+    if labels is None:
+      labels = [None] * len(roi_ids)
+    if not isinstance(signals, list):
+      signals = [signals]
+    num_frames = sum(s.shape[1] for s in signals)
+    with self._lock():
+      connection = sqlite3.connect(self.path)
+      with connection:
+        connection.execute(
+          "DELETE FROM signals WHERE recording_id IN (SELECT id FROM"
+          " recordings WHERE settings = ? AND recording = ?)",
+          (settings, recording))
+        connection.execute(
+          "DELETE FROM recordings WHERE settings = ? AND recording = ?",
+          (settings, recording))
+        cursor = connection.execute(
+          "INSERT INTO recordings (settings, recording, num_frames,"
+          " frames_per_second) VALUES (?, ?, ?, ?)",
+          (settings, recording, num_frames, frames_per_second))
+        recording_id = cursor.lastrowid
+        for start in xrange(0, len(roi_ids), block_rois):
+          stop = start + block_rois
+          block = concatenate([asarray(s[start:stop], dtype=float32)
+                               for s in signals], axis=1)
+          rows = [(int(rid), label, sqlite3.Binary(signal.tostring()))
+                  for rid, label, signal in zip(roi_ids[start:stop],
+                                                labels[start:stop], block)]
+          connection.executemany(
+            "INSERT INTO signals (recording_id, roi_id, label, data)"
+            " VALUES (%d, ?, ?, ?)" % recording_id, rows)
+      connection.close()
+
+  def add_file(self, settings, recording, path):
+    """Adds signals exported by :meth:`sara.SaraUI.exportSignal`
+
+    *path* may be a tab-separated, ``.npz`` or ``.npy`` signal file.
+
+    """
+    self.add(settings, recording, *read_signals(path))
+
+  def get(self, settings, recording, roi_id=None):
+    """Returns the signals of one recording.
+
+    Args:
+      settings (str): Name of the settings file used for analysis.
+      recording (str): Name of the recording.
+      roi_id (int, optional): Only return this ROI's signal.
+    Returns:
+      tuple: a list of ROI ids and an array of shape
+      ``(num_rois, num_frames)``.
+
+    """
+    query = "SELECT roi_id, data FROM signals JOIN recordings" \
+            " ON recording_id = id WHERE settings = ? AND recording = ?"
+    args = [settings, recording]
+    if roi_id is not None:
+      query += " AND roi_id = ?"
+      args.append(roi_id)
+    with self._lock():
+      connection = sqlite3.connect(self.path)
+      rows = connection.execute(query + " ORDER BY roi_id", args).fetchall()
+      connection.close()
+    roi_ids = [row[0] for row in rows]
+    signals = array([frombuffer(row[1], dtype=float32) for row in rows])
+    return roi_ids, signals
+
+  def recordings(self, settings=None):
+    """Returns a list of (settings, recording) pairs in the store"""
+    query = "SELECT settings, recording FROM recordings"
+    args = []
+    if settings is not None:
+      query += " WHERE settings = ?"
+      args.append(settings)
+    with self._lock():
+      connection = sqlite3.connect(self.path)
+      rows = connection.execute(query + " ORDER BY settings, recording",
+                                args).fetchall()
+      connection.close()
+    return rows
+
+def read_signals(path):
+  """Reads signals exported by :meth:`sara.SaraUI.exportSignal`
+
+  Args:
+    path (str): A tab-separated, ``.npz`` or ``.npy`` signal file.
+  Returns:
+    tuple: ROI ids, an array of signals of shape ``(num_rois,
+    num_frames)``, ROI labels, and the capture rate in frames per second
+    (``None`` if signals are labeled by frame number).
+
+  """
+  frames_per_second = None
+  if path.endswith('.npz') or path.endswith('.npy'):
+    if path.endswith('.npz'):
+      data = load(path)
+      signals = data['signals']
+    else:
+      data = load(splitext(path)[0] + '_meta.npz')
+      signals = load(path, mmap_mode='r')
+    roi_ids, labels = data['roi_ids'], data['roi_labels']
+    if 'time' in data.files and len(data['time']) > 1:
+      frames_per_second = 1. / (data['time'][1] - data['time'][0])
+  else:
+    with open(path) as fh:
+      reader = csv.reader(fh, delimiter='\t')
+      header = reader.next()
+      labels = reader.next()[2:]
+    roi_ids = header[2:]
+    columns = loadtxt(path, delimiter='\t', skiprows=3, ndmin=2)
+    signals = columns[:, 2:].T
+    if header[1] == 'time' and len(columns) > 1:
+      frames_per_second = 1. / (columns[1, 1] - columns[0, 1])
+  return roi_ids, signals, labels, frames_per_second
+
+def aggregate(store, out_dir):
+  """Adds every signal file under *out_dir* that isn't in *store* yet
+
+  *out_dir* is expected to have the layout created by ``sge_run.sh``:
+  ``out_dir/<settings>/signals/<recording>.<ext>``.
+
+  Returns:
+    int: The number of signal files added.
+
+  """
+  stored = set(store.recordings())
+  added = 0
+  for settings in sorted(listdir(out_dir)):
+    signals_dir = join(out_dir, settings, 'signals')
+    if not isdir(signals_dir):
+      continue
+    for filename in sorted(listdir(signals_dir)):
+      recording, ext = splitext(filename)
+      if recording.endswith('_meta') or ext not in ['.csv', '.npz', '.npy']:
+        continue
+      if (settings, recording) not in stored:
+        store.add_file(settings, recording, join(signals_dir, filename))
+        added += 1
+  return added
+
+if __name__ == '__main__':
+  if len(argv) != 3:
+    print "Usage: %s store_file out_dir" % argv[0]
+    print "  Adds all signals in out_dir/*/signals that aren't already in"
+    print "  store_file (an SQLite database, created if needed)"
+    exit()
+  added = aggregate(SignalStore(argv[1]), argv[2])
+  print added, "signal files added"
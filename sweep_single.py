@@ -0,0 +1,74 @@
+#!/opt/python/bin/python2.7
+# Evaluate every settings file in a sweep against one recording, loading and
+# motion-correcting the recording only once
+from os import listdir, mkdir
+from os.path import join, isdir, split
+from sys import argv
+from image_index import image_path
+from sara import SaraUI, render_plots
+
+if len(argv) != 4:
+  program_name = argv[0]
+  print "Usage: %s job_id settings_dir out_dir" % program_name
+  print "  'job_id' is the nth image file to analyze"
+  print "  'settings_dir' is the directory of settings files to evaluate"
+  print "  'out_dir' is the directory where output will go"
+  print ""
+  print "  Output for each settings file goes to out_dir/<settings name>,"
+  print "  in the same layout used by sge_run.sh"
+  exit()
+
+# Nth image file to analyze
+job_id = int(argv[1])
+# Directory containing one settings file per parameter combination
+settings_dir = argv[2]
+# Output directory
+outdir = argv[3]
+
+def makedir(d):
+  if not isdir(d):
+    mkdir(d)
+
+def sweep_sara(dirpath, recording, settings_files, outdir):
+  """Segment one recording with every settings file in a sweep"""
+  # remove .tif extension
+  no_ex = recording[:recording.find('.tif')]
+  # output locations shared by all settings
+  for d in ['corrected', 'analysis']:
+    makedir(join(outdir, d))
+  sima_dir = join(outdir, 'analysis', no_ex + '.sima')
+  mc_infile = join(dirpath, recording)
+  mc_outfile = join(outdir, 'corrected', recording)
+
+  # run analysis; all settings files share motion correction settings
+  print "Analyzing", recording
+  ui = SaraUI(sima_dir, settings_files[0])
+  ui.motionCorrect(mc_infile, mc_outfile, use_settings=True)
+  labels = ui.segmentSweep(settings_files)
+
+  plots = []
+  for settings_name, label in sorted(labels.iteritems()):
+    settings_out = join(outdir, settings_name)
+    for d in ['', 'plots', 'signals']:
+      makedir(join(settings_out, d))
+    ui.rois = ui.dataset.ROIs[label]
+    ui.rois_label = label
+    ui.exportSignal(join(settings_out, 'signals', no_ex + '.csv'),
+                    use_settings=True)
+    ui.score()
+    plots.append((sima_dir, settings_files[0], label,
+                  join(settings_out, 'plots', recording)))
+
+  # plots are independent of each other, so render them side by side; the
+  # background thumbnail they share is saved to sima_dir first, so that
+  # workers load it instead of each computing the time averages
+  processes = int(ui._setting('plot_processes', 1))
+  if processes > 1:
+    ui._thumbnail()
+  render_plots(plots, processes, ui)
+
+settings_files = sorted(join(settings_dir, f) for f in listdir(settings_dir))
+
+dirpath, recording = split(image_path(job_id))
+sweep_sara(dirpath, recording, settings_files, outdir)
+print "Analysis done"